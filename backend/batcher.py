@@ -0,0 +1,225 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+from itertools import chain
+from threading import Condition, Event, Thread, local
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+from metrics import Metrics, record, recording
+from reason import MAXIMUM_BATCH_SIZE, bind, embed, generate
+
+BATCH_WAIT = float(os.environ.get("HAICOR_BATCH_WAIT", 0.01))  # in seconds
+BATCH_SIZE = int(os.environ.get("HAICOR_BATCH_SIZE", MAXIMUM_BATCH_SIZE))
+
+
+class Cancelled(Exception):
+    """Raised inside a job once it has been cancelled, see `Reasoner.cancel`."""
+
+
+LOCAL = local()  # the job the calling thread works for, see `owning`
+
+
+@contextmanager
+def owning(owner: str) -> Iterator[None]:
+    """Attribute the requests made by the calling thread to job `owner`, so
+    they can be dropped with `Batcher.cancel`."""
+    previous = getattr(LOCAL, "owner", None)
+    LOCAL.owner = owner
+    try:
+        yield
+    finally:
+        LOCAL.owner = previous
+
+
+class Request:
+    def __init__(self, input: list[str], number: int, kind: str = "generate"):
+        self.input: list[str] = input
+        self.number: int = number
+        self.kind: str = kind  # `generate` or `embed`
+        self.owner: Optional[str] = getattr(LOCAL, "owner", None)
+
+        self.arrival: float = time.monotonic()
+        self.done: Event = Event()
+        self.result: list[tuple[str, str, float]] | np.ndarray = []
+        self.error: Optional[BaseException] = None
+        self.counters: dict[str, float] = {}  # its share of the batch counters
+
+
+class Batcher:
+    """Gathers `generate` calls from concurrent jobs into shared model batches.
+
+    Requests are grouped by the model they target (`glucose:` or `mnli`) and by
+    their number of return sequences. A group is sent to the model once it has
+    `size` prompts or its oldest request has waited `wait` seconds, whichever
+    comes first. Each device entry gets a thread owning its own model replica,
+    all of them serving the same pending groups. Batches are served by
+    `generator`, which defaults to `reason.generate`. Texts to embed (see
+    `embed`) are grouped and served the same way, by `embedder`, which defaults
+    to `reason.embed`.
+
+    The counters recorded while serving a batch (see `metrics.record`) are split
+    among its requests by their share of prompts, and recorded again by the
+    threads waiting on them.
+    """
+
+    def __init__(self, devices: list[str], wait: float = BATCH_WAIT, size: int = BATCH_SIZE, generator: Callable[[list[str], int], list[tuple[str, str, float]]] = generate, embedder: Callable[[list[str]], np.ndarray] = embed):
+        self.access: Condition = Condition()
+
+        self.generator: Callable[[list[str], int], list[tuple[str, str, float]]] = generator
+        self.embedder: Callable[[list[str]], np.ndarray] = embedder
+        self.wait: float = wait
+        self.size: int = size
+        self.pending: dict[tuple[str, int], list[Request]] = {}
+        self.stopped: bool = False
+
+        self.threads: list[Thread] = [
+            Thread(target=self.run, args=(device, replica), name=f"batcher-{replica}")
+            for replica, device in enumerate(devices)]
+
+        # batching statistics
+        self.batches: int = 0
+        self.prompts: int = 0
+        self.requests: int = 0
+        self.dropped: int = 0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        with self.access:
+            self.stopped = True
+            self.access.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+    def generate(self, input: list[str] | str, number: int) -> list[tuple[str, str, float]]:
+        """Same as `reason.generate`, but batched with other concurrent calls."""
+        input = [input] if isinstance(input, str) else input
+        if not input:
+            return []
+
+        key = ("glucose" if input[0].startswith("glucose:") else "mnli", number)
+        return self.submit(key, Request(input, number))
+
+    def embed(self, input: list[str]) -> np.ndarray:
+        """Same as `reason.embed`, but batched with other concurrent calls."""
+        return self.submit(("embed", 1), Request(input, 1, "embed"))
+
+    def submit(self, key: tuple[str, int], request: Request) -> list[tuple[str, str, float]] | np.ndarray:
+        """Add `request` to the `key` group and wait for its result."""
+        with self.access:
+            self.pending.setdefault(key, []).append(request)
+            self.access.notify_all()
+
+        request.done.wait()
+        record(requests=1, **request.counters)
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def cancel(self, owner: str) -> int:
+        """Drop the pending requests of job `owner`, returns how many.
+
+        Their callers raise `Cancelled`; requests already being served finish.
+        """
+        with self.access:
+            dropped = 0
+            for key, group in list(self.pending.items()):
+                for request in group:
+                    if request.owner == owner:
+                        request.error = Cancelled(owner)
+                        request.done.set()
+                        dropped += 1
+
+                if kept := [i for i in group if i.owner != owner]:
+                    self.pending[key] = kept
+                else:
+                    del self.pending[key]
+
+            self.dropped += dropped
+            self.access.notify_all()
+
+            return dropped
+
+    def run(self, device: str, replica: int):
+        bind(device, replica)
+
+        while (batch := self.collect()) is not None:
+            input = list(chain.from_iterable(i.input for i in batch))
+            usage = Metrics()
+            try:
+                with recording(usage):
+                    if batch[0].kind == "embed":
+                        results = self.embedder(input)
+                    else:
+                        results = self.generator(input, batch[0].number)
+            except Exception as error:  # hand the failure to the waiting jobs
+                for request in batch:
+                    request.error = error
+                    request.done.set()
+                continue
+
+            # scatter results (and counters) back to the waiting jobs
+            offset = 0
+            for request in batch:
+                length = len(request.input) * request.number
+                request.result = results[offset:offset + length]
+                request.counters = dict((name, value * len(request.input) / len(input))
+                                        for name, value in usage.counters.items())
+                request.done.set()
+
+                offset += length
+
+    def collect(self) -> Optional[list[Request]]:
+        with self.access:
+            while True:
+                while not self.pending and not self.stopped:
+                    self.access.wait()
+                if not self.pending:  # stopped with nothing left to serve
+                    return None
+
+                # wait for the oldest group to fill up or to time out
+                key = next(iter(self.pending))
+                deadline = self.pending[key][0].arrival + self.wait
+                while (key in self.pending
+                       and sum(len(i.input) for i in self.pending[key]) < self.size
+                       and (remaining := deadline - time.monotonic()) > 0):
+                    self.access.wait(remaining)
+
+                if key in self.pending:  # otherwise taken by another thread
+                    break
+
+            group, batch, size = self.pending[key], [], 0
+            while group and (not batch or size + len(group[0].input) <= self.size):
+                batch.append(group.pop(0))
+                size += len(batch[-1].input)
+
+            if not group:
+                del self.pending[key]
+
+            self.batches += 1
+            self.prompts += size
+            self.requests += len(batch)
+
+            return batch
+
+    def stats(self) -> dict:
+        """Returns the number of batches, prompts, and requests served, and
+        of requests dropped by `cancel`."""
+        with self.access:
+            return {"batches": self.batches,
+                    "prompts": self.prompts,
+                    "requests": self.requests,
+                    "dropped": self.dropped,
+                    "mean_size": self.prompts / (self.batches or 1)}
@@ -0,0 +1,27 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Benchmarks of the backend, run from the `backend` directory as modules."""
+from __future__ import annotations
+
+import os
+from itertools import islice
+
+from stories import read_stories
+
+# the story used without (or instead of) the ROCStories Dataset
+CONTEXT = ["Tom was hungry after a long day at work.",
+           "He opened the fridge and found nothing to eat.",
+           "He decided to order a pizza from the local shop.",
+           "The delivery took almost an hour to arrive.",
+           "Tom ate the whole pizza and fell asleep on the couch."]
+
+
+def stories(path: str, total: int) -> list[list[str]]:
+    """Returns the lines of the first `total` stories of the dataset CSV at
+    `path`, or of the `CONTEXT` story alone when the file is missing."""
+    if not os.path.exists(path):
+        return [CONTEXT]
+
+    return [lines for _, _, lines in islice(read_stories(path), total)]
@@ -0,0 +1,96 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Encoder FLOPs saved by the encoder state cache, behind the generation cache.
+
+Replays a `--workload` over the first `--stories` stories through
+`reason.generate`, with the (in memory) generation cache enabled as in the real
+pipeline, so exact repeats are answered before any encoder runs. A workload is
+a comma separated list of steps run on every story in turn: `step:N` queries
+every sentence with every aspect for `N` results (the step view), `graph:N`
+queries the same prompts as the first forward layer of a graph search with
+branching factor `N`. Only prompts repeated with another number of results
+reach the encoder again, and only those can hit `reason.ENCODERS`.
+
+Reports the generation and encoder cache counters, and the encoder FLOPs
+computed and saved (estimated analytically from the model configuration at the
+mean prompt length), as JSON. Also reports the fraction of prompt tokens that
+are story context, shared by the aspect prompts but not reusable since the T5
+encoder attends bidirectionally.
+
+Run from the `backend` directory: `python -m benchmarks.encoder_flops`.
+"""
+from __future__ import annotations
+
+import os
+
+# exact repeats are served by the generation cache (in memory, not from disk)
+os.environ.update(HAICOR_CACHE_PATH="")
+os.environ.setdefault("HAICOR_ENCODER_CACHE_SIZE", "65536")
+
+import argparse
+import json
+import time
+
+import reason
+from benchmarks import stories
+from graph import ASPECTS
+from reason import DEVICE, Model, bind, prompt
+
+
+def encoder_flops(config, length: int) -> int:
+    """Multiply-add FLOPs (counted as 2) of encoding `length` tokens."""
+    inner = config.num_heads * config.d_kv
+    matrices = 3 if config.feed_forward_proj.startswith("gated") else 2
+
+    projections = 2 * 4 * config.d_model * inner  # query, key, value, output
+    feed_forward = 2 * matrices * config.d_model * config.d_ff
+    attention = 2 * 2 * length * inner  # scores and weighted values
+
+    return config.num_layers * length * (projections + feed_forward + attention)
+
+
+def estimate(config, prompts: int, tokens: int) -> int:
+    return prompts and prompts * encoder_flops(config, round(tokens / prompts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", default="step:5,graph:3,graph:3")
+    parser.add_argument("--stories", type=int, default=4)
+    parser.add_argument("--dataset", default="./rocstory.csv")
+    parser.add_argument("--checkpoint", default=reason.CS_CHECKPOINT)
+    parser.add_argument("--device", default=DEVICE)
+    args = parser.parse_args()
+
+    reason.MODELS["glucose"] = Model(args.checkpoint)
+    bind(args.device)
+    token, model = reason.MODELS["glucose"].load(args.device)
+
+    start = time.perf_counter()
+    prompt_tokens = context_tokens = 0
+    for lines in stories(args.dataset, args.stories):
+        prompts = [prompt("general", "forward", aspect, lines, line)
+                   for line in lines for aspect in ASPECTS]
+        for step in args.workload.split(","):
+            _, number = step.split(":")
+            reason.generate(prompts, int(number))
+
+        prompt_tokens += sum(map(len, token(prompts, truncation=True,
+                                            max_length=reason.PROMPT_LENGTH).input_ids))
+        context_tokens += len(prompts) * (len(token(" ".join(lines)).input_ids) - 1)
+
+    encoders, generations = reason.ENCODERS.stats(), reason.CACHE.stats()
+    computed = estimate(model.config, encoders["misses"], encoders["miss_tokens"])
+    saved = estimate(model.config, encoders["hits"], encoders["hit_tokens"])
+
+    print(json.dumps({"workload": args.workload,
+                      "stories": args.stories,
+                      "seconds": time.perf_counter() - start,
+                      "computed_encoder_flops": computed,
+                      "saved_encoder_flops": saved,
+                      "saved_ratio": saved / ((computed + saved) or 1),
+                      "context_token_ratio": context_tokens / (prompt_tokens or 1),
+                      "generation_cache": generations,
+                      "encoder_cache": encoders}, indent=2))
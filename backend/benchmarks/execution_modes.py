@@ -0,0 +1,107 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Accuracy and speed check of the model execution modes against fp32.
+
+Builds `--prompts` GLUCOSE prompts (for the `glucose` model) or entailment
+prompts (for the `mnli` model) from the first stories in `--stories` (or from
+a built-in story when the file is missing), and runs `reason.query` over them
+with the model loaded in fp32 and in every one of `--modes` (a CPU mode, `fp32`,
+`int8`, or `bf16`, optionally followed by `+compile` or `+trace`), bypassing
+the caches.
+
+For every mode it reports the time taken, how often the generated strings match
+the fp32 strings at the same rank (and as a set per prompt), and how far the
+`sequences_scores` of matching strings drift, as JSON. Path scores multiply up
+to `2 * length + 1` such scores, so `path_drift` is the log score drift
+compounded over a path of `--length` layers per side.
+
+Run from the `backend` directory: `python -m benchmarks.execution_modes`.
+"""
+from __future__ import annotations
+
+import os
+
+os.environ.update(HAICOR_ENCODER_CACHE_SIZE="0")  # states differ between modes
+
+import argparse
+import json
+import math
+import time
+from itertools import islice, product
+
+from benchmarks import stories
+from reason import CS_CHECKPOINT, T5_CHECKPOINT, Model, prompt, query
+
+
+def prompts(name: str, path: str, total: int) -> list[str]:
+    if name == "glucose":
+        results = (prompt("general", order, "causal", lines, line)
+                   for lines in stories(path, max(total // 5, 1)) for line in lines
+                   for order in ("forward", "backward"))
+    else:
+        results = (f"mnli hypothesis: {hypothesis} premise: {premise}"
+                   for lines in stories(path, max(total // 5, 1))
+                   for premise, hypothesis in product(lines, repeat=2))
+
+    return list(islice(results, total))
+
+
+def run(model: Model, device: str, input: list[str], number: int) -> tuple[float, list]:
+    token, loaded = model.load(device)
+    query(token, loaded, input[:2], number)  # warm up (and compile)
+
+    start = time.perf_counter()
+    results = query(token, loaded, input, number)
+    return time.perf_counter() - start, results
+
+
+def compare(baseline: list, results: list, number: int, length: int) -> dict:
+    matched, drift = 0, []
+    for i, j in zip(baseline, results):
+        if i[1] == j[1]:
+            matched += 1
+            drift.append(abs(math.log(j[2]) - math.log(i[2])))
+
+    same_sets = sum(
+        {i[1] for i in baseline[k:k + number]} == {i[1] for i in results[k:k + number]}
+        for k in range(0, len(baseline), number))
+
+    mean = sum(drift) / len(drift) if drift else 0.0
+    return {"string_agreement": matched / len(baseline),
+            "set_agreement": same_sets / (len(baseline) // number),
+            "mean_log_score_drift": mean,
+            "max_log_score_drift": max(drift, default=0.0),
+            "path_drift": (2 * length + 1) * mean}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", choices=["glucose", "mnli"], default="glucose")
+    parser.add_argument("--checkpoint", help="defaults to the checkpoint of `--model`")
+    parser.add_argument("--modes", default="int8,bf16,fp32+compile,int8+trace")
+    parser.add_argument("--prompts", type=int, default=64)
+    parser.add_argument("--number", type=int, default=3)
+    parser.add_argument("--length", type=int, default=2)
+    parser.add_argument("--stories", default="./rocstory.csv")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or (CS_CHECKPOINT if args.model == "glucose" else T5_CHECKPOINT)
+    input = prompts(args.model, args.stories, args.prompts)
+
+    baseline_time, baseline = run(Model(checkpoint, "fp32", ""), args.device, input, args.number)
+
+    report = {"prompts": len(input), "fp32_seconds": baseline_time, "modes": {}}
+    for name in args.modes.split(","):
+        cpu_mode, _, compile = name.partition("+")
+        model = Model(checkpoint, cpu_mode, compile)
+
+        seconds, results = run(model, args.device, input, args.number)
+        report["modes"][name] = {"mode": model.mode(args.device),  # as actually run
+                                 "seconds": seconds,
+                                 "speedup": baseline_time / seconds,
+                                 **compare(baseline, results, args.number, args.length)}
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,104 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Memory benchmark of the reasoning graph representations.
+
+Builds the same synthetic forward search (one source, `--layers` layers of
+`--children` inferences per node) as a `networkx.DiGraph` with uuid nodes and
+per-edge prompt strings (the original representation) and as a
+`ReasoningGraph`, and reports the bytes allocated by each, as JSON.
+
+Run from the `backend` directory: `python -m benchmarks.graph_memory`.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import tracemalloc
+from itertools import cycle
+from uuid import uuid4
+
+import networkx as nx
+
+from benchmarks import CONTEXT
+from graph import ASPECTS, FORWARD, ReasoningGraph
+from reason import prompt
+
+
+def inferences(layers: int, children: int):
+    """Yield `(layer, parent index, text, result, score)` of a synthetic search."""
+    aspects, width = cycle(ASPECTS), 1
+    for layer in range(layers):
+        for parent in range(width):
+            for child in range(children):
+                text = f"Someone_{layer} feels state {parent}-{child}"
+                yield layer, parent, next(aspects), text, f"Something > Causes/Enables > {text}", 0.5
+
+        width *= children
+
+
+def build_networkx(layers: int, children: int) -> nx.DiGraph:
+    graph = nx.DiGraph(context=CONTEXT)
+
+    source = str(uuid4())
+    graph.add_node(source, kind="source", text=CONTEXT[0])
+
+    previous, current, last = [source], [], 0
+    for layer, parent, aspect, text, result, score in inferences(layers, children):
+        if layer != last:
+            previous, current, last = current, [], layer
+
+        node, parent = str(uuid4()), previous[parent]
+        usage = "general" if graph.nodes[parent]["kind"] == "source" else "premise"
+
+        graph.add_node(node, kind="middle", text=text)
+        graph.add_edge(parent, node, aspect=aspect, result=result, score=score,
+                       prompt=prompt(usage, "forward", aspect, CONTEXT, graph.nodes[parent]["text"]))
+        current.append(node)
+
+    return graph
+
+
+def build_compact(layers: int, children: int) -> ReasoningGraph:
+    graph = ReasoningGraph(CONTEXT)
+
+    previous, current, last = [graph.add_node("source", CONTEXT[0])], [], 0
+    for layer, parent, aspect, text, result, score in inferences(layers, children):
+        if layer != last:
+            previous, current, last = current, [], layer
+
+        node = graph.add_node("middle", text, score)
+        graph.add_edge(previous[parent], node, FORWARD, aspect, result, score)
+        current.append(node)
+
+    return graph
+
+
+def measure(build, *args) -> tuple[int, object]:
+    tracemalloc.start()
+    graph = build(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size, graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--children", type=int, default=15)
+    args = parser.parse_args()
+
+    networkx_bytes, graph = measure(build_networkx, args.layers, args.children)
+    nodes, edges = graph.number_of_nodes(), graph.number_of_edges()
+    del graph
+
+    compact_bytes, graph = measure(build_compact, args.layers, args.children)
+    assert (nodes, edges) == (graph.number_of_nodes(), graph.number_of_edges())
+
+    print(json.dumps({"nodes": nodes,
+                      "edges": edges,
+                      "networkx_bytes": networkx_bytes,
+                      "compact_bytes": compact_bytes,
+                      "ratio": networkx_bytes / compact_bytes}, indent=2))
@@ -0,0 +1,60 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Speed benchmark of entailment classification against beam search.
+
+Builds `--pairs` premise and hypothesis pairs from the sentences of the first
+stories in `--stories` (or from a built-in story when the file is missing) and
+labels them with both `reason.query` (beam search, the `generate` mode) and
+`reason.classify` (label scoring, the `classify` mode), bypassing the cache.
+Reports the time taken by each and how often their labels agree, as JSON.
+
+Run from the `backend` directory: `python -m benchmarks.mnli_classify`.
+"""
+from __future__ import annotations
+
+import os
+
+# `classify` would reuse the encoder states of the `query` run before it
+os.environ.update(HAICOR_ENCODER_CACHE_SIZE="0")
+
+import argparse
+import json
+import time
+from itertools import islice, product
+
+from benchmarks import stories
+from reason import DEVICE, T5_CHECKPOINT, Model, classify, query
+
+
+def measure(function, *args) -> tuple[float, list]:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=256)
+    parser.add_argument("--stories", default="./rocstory.csv")
+    parser.add_argument("--checkpoint", default=T5_CHECKPOINT)
+    parser.add_argument("--device", default=DEVICE)
+    args = parser.parse_args()
+
+    texts = [line for lines in stories(args.stories, max(args.pairs // 20, 1)) for line in lines]
+    prompts = [f"mnli hypothesis: {hypothesis} premise: {premise}"
+               for premise, hypothesis in islice(product(texts, repeat=2), args.pairs)]
+
+    token, model = Model(args.checkpoint).load(args.device)
+    classify(token, model, prompts[:8])  # warm up
+
+    generate_time, generated = measure(query, token, model, prompts, 1)
+    classify_time, classified = measure(classify, token, model, prompts)
+
+    print(json.dumps({"pairs": len(prompts),
+                      "generate_seconds": generate_time,
+                      "classify_seconds": classify_time,
+                      "speedup": generate_time / classify_time,
+                      "agreement": sum(i[1] == j[1] for i, j in zip(generated, classified)) / len(prompts)},
+                     indent=2))
@@ -0,0 +1,206 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Throughput benchmark of the reasoning pipelines with a pluggable model.
+
+Runs `Reasoner.reason_path` and `Reasoner.reason_graph` jobs over a grid of
+`--lengths` and `--branches` with every cache disabled, against one of two
+model backends:
+
+* `fake`: a deterministic stand-in for T5 emitting well-formed `a > b > c`
+  inferences (and entailment labels), sleeping `--latency` seconds per batch
+  plus `--prompt-latency` seconds per prompt, without an encoder to retrieve
+  entailment candidates with (so `--candidates` defaults to exact pairing);
+* `tiny`: a randomly initialized tiny T5 (built with the `--tokenizer`
+  tokenizer) doing real tensor work on the `HAICOR_WORKERS` devices, whose
+  outputs are reshaped into well-formed inferences so the search keeps going.
+
+For every grid point it reports prompts per second, graph nodes per second,
+the wall time of every stage (forward and backward search, connection, path
+search), and peak memory, and writes them as JSON to `--output` so runs on
+different commits can be compared (see `--compare`).
+
+Run from the `backend` directory: `python -m benchmarks.pipeline`.
+"""
+from __future__ import annotations
+
+import os
+
+# every cache would turn repeated grid points into lookups
+os.environ.update(HAICOR_CACHE_PATH="", HAICOR_CACHE_SIZE="0", HAICOR_GRAPH_STORE="",
+                  HAICOR_ENCODER_CACHE_SIZE="0")
+
+import argparse
+import json
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import zlib
+from typing import Callable
+
+import torch
+from transformers import T5Config, T5ForConditionalGeneration, T5Tokenizer
+
+import reason
+import thread
+from benchmarks import CONTEXT
+from reason import MNLI_LABELS, T5_CHECKPOINT
+
+TARGET = "Tom felt full."
+
+Generator = Callable[[list[str], int], list[tuple[str, str, float]]]
+
+
+# ================================== BACKENDS ==================================
+def digest(*values) -> int:
+    return zlib.crc32(json.dumps(values).encode())
+
+
+def inference(input: str, index: int) -> str:
+    """A well-formed inference for the `index`th result of prompt `input`."""
+    return (f"Someone_A {digest(input, index, 0) % 97} > Causes/Enables > "
+            f"Someone_A {digest(input, index, 1) % 97}")
+
+
+def fake_backend(latency: float, prompt_latency: float) -> Generator:
+    def generate(input: list[str], number: int) -> list[tuple[str, str, float]]:
+        time.sleep(latency + prompt_latency * len(input))
+
+        results = []
+        for i in input:
+            for index in range(number):
+                if i.startswith("mnli"):
+                    label = MNLI_LABELS[digest(i) % len(MNLI_LABELS)]
+                    results.append((i, label, 0.5 + digest(i, 1) % 50 / 100))
+                else:
+                    results.append((i, inference(i, index), 0.9 ** (index + 1)))
+
+        return results
+
+    return generate
+
+
+def tiny_backend(tokenizer: str, seed: int) -> Generator:
+    token = T5Tokenizer.from_pretrained(tokenizer)
+
+    torch.manual_seed(seed)
+    config = T5Config(vocab_size=len(token), d_model=64, d_ff=128, d_kv=32, num_heads=2,
+                      num_layers=2, decoder_start_token_id=token.pad_token_id)
+
+    # loaded through `reason.Model`, like any other checkpoint
+    checkpoint = tempfile.mkdtemp(prefix="haicor-tiny-")
+    T5ForConditionalGeneration(config).save_pretrained(checkpoint)
+    token.save_pretrained(checkpoint)
+    reason.MODELS = {"glucose": reason.Model(checkpoint), "mnli": reason.Model(checkpoint)}
+
+    def generate(input: list[str], number: int) -> list[tuple[str, str, float]]:
+        results = reason.generate(input, number)  # `number` results per prompt
+        return [(i, result if i.startswith("mnli") else inference(i, index % number), score)
+                for index, (i, result, score) in enumerate(results)]
+
+    return generate
+# ================================== BACKENDS ==================================
+
+
+def run(task: str, length: int, branch: int, total: int, candidates: int) -> dict:
+    """Run one `task` job and time its stages from its published states."""
+    if task == "path":
+        uuid = thread.reasoner.submit_path(
+            CONTEXT[0], TARGET, CONTEXT, length, branch, total, candidates)
+    else:
+        uuid = thread.reasoner.submit_graph(
+            TARGET, CONTEXT, length, branch, total, candidates)
+
+    before = thread.batcher.stats()
+    tracemalloc.start()
+    start = last = time.perf_counter()
+
+    stages, version, state = {}, None, "waiting"
+    while state not in thread.FINISHED:
+        version, current, partial = thread.reasoner.watch(uuid, version, 60)
+        if current != state:  # stage names drop the layer number
+            now = time.perf_counter()
+            stage = {"f": "forward", "b": "backward", "c": "connect", "s": "search"}.get(state[0], state)
+            stages[stage] = stages.get(stage, 0.0) + now - last
+            state, last = current, now
+
+    if state != "stopped":
+        raise RuntimeError(f"{task} job {state}: {partial.get('error', '')}")
+
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    after = thread.batcher.stats()
+    nodes = sum(map(len, partial.get("forward", []) + partial.get("backward", [])))
+    thread.reasoner.obtain_result(uuid)
+
+    prompts = after["prompts"] - before["prompts"]
+    return {"task": task, "length": length, "branch": branch,
+            "seconds": seconds,
+            "prompts": prompts,
+            "prompts_per_second": prompts / seconds,
+            "nodes": nodes,
+            "nodes_per_second": nodes / seconds,
+            "stages": stages,
+            "python_peak_bytes": peak,
+            "process_peak_kilobytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "device_peak_bytes": torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0}
+
+
+def compare(previous: dict, current: dict):
+    points = dict(((i["task"], i["length"], i["branch"]), i) for i in previous["results"])
+    for result in current["results"]:
+        if (old := points.get((result["task"], result["length"], result["branch"]))) is not None:
+            print(f"{result['task']} length={result['length']} branch={result['branch']}: "
+                  f"{result['prompts_per_second'] / old['prompts_per_second']:.2f}x prompts/s, "
+                  f"{old['seconds'] / result['seconds']:.2f}x speed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["fake", "tiny"], default="fake")
+    parser.add_argument("--tasks", default="path,graph")
+    parser.add_argument("--lengths", default="1,2")
+    parser.add_argument("--branches", default="1,2")
+    parser.add_argument("--total", type=int, default=5)
+    parser.add_argument("--candidates", type=int)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--prompt-latency", type=float, default=0.0005)
+    parser.add_argument("--tokenizer", default=T5_CHECKPOINT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="an earlier `--output` to compare with")
+    args = parser.parse_args()
+
+    if args.backend == "fake":
+        thread.batcher.generator = fake_backend(args.latency, args.prompt_latency)
+        args.candidates = 0 if args.candidates is None else args.candidates
+    else:
+        thread.batcher.generator = tiny_backend(args.tokenizer, args.seed)
+        args.candidates = thread.CANDIDATES if args.candidates is None else args.candidates
+
+    thread.batcher.start()
+    thread.reasoner.start()
+    try:
+        results = [run(task, length, branch, args.total, args.candidates)
+                   for task in args.tasks.split(",")
+                   for length in map(int, args.lengths.split(","))
+                   for branch in map(int, args.branches.split(","))]
+    finally:
+        thread.reasoner.stop()
+        thread.batcher.stop()
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                            capture_output=True, text=True).stdout.strip()
+    report = {"commit": commit, "settings": vars(args), "results": results}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare(json.load(file), report)
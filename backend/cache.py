@@ -0,0 +1,178 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable, Optional
+
+Entry = list[tuple[str, float]]  # the `(result, score)` pairs of one prompt
+
+
+def checkpoint_identity(path: str) -> str:
+    """Compute an identity string for the model checkpoint at `path`.
+
+    Local checkpoints are identified by the name, size, and modification time
+    of every file inside the checkpoint directory, so retraining the model into
+    the same directory invalidates the old entries. Remote checkpoints (such as
+    `t5-small`) are identified by their name.
+
+    Parameters
+    ----------
+    path : str
+        The path (or hub name) the checkpoint is loaded from.
+
+    Returns
+    -------
+    str
+        A hexadecimal digest identifying the checkpoint.
+    """
+    digest = hashlib.sha256(path.encode())
+
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    return digest.hexdigest()
+
+
+class GenerationCache:
+    """Two tier (memory and disk) cache of language model generations.
+
+    Entries are content addressed: the key is a digest over the checkpoint
+    identity, the prompt, and every generation setting that affects the output.
+    The memory tier is a bounded LRU; the disk tier is an unbounded SQLite table
+    shared across processes and restarts.
+    """
+
+    def __init__(self, path: Optional[str], capacity: int):
+        self.access: Lock = Lock()
+
+        self.capacity: int = capacity
+        self.memory: OrderedDict[str, Entry] = OrderedDict()
+
+        self.disk: Optional[sqlite3.Connection] = None
+        if path:
+            self.disk = sqlite3.connect(path, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS generation "
+                              "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.disk.commit()
+
+        self.counters: dict[str, int] = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(model: str, input: str, *settings) -> str:
+        return hashlib.sha256(
+            json.dumps([model, input, *settings]).encode()).hexdigest()
+
+    def lookup(self, keys: list[str]) -> list[Optional[Entry]]:
+        """Look up `keys`, returning `None` for every key not cached."""
+        with self.access:
+            results, missing = [], []
+            for key in keys:
+                if (entry := self.memory.get(key)) is not None:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                else:
+                    missing.append(key)
+                results.append(entry)
+
+            if missing and self.disk is not None:
+                found = {}
+                for i in range(0, len(missing), 512):  # SQLite variable limit
+                    batch = list(set(missing[i:i + 512]))
+                    found.update(self.disk.execute(
+                        f"SELECT key, value FROM generation WHERE key IN "
+                        f"({', '.join('?' * len(batch))})", batch))
+
+                for index, key in enumerate(keys):
+                    if results[index] is None and key in found:
+                        results[index] = [tuple(i) for i in json.loads(found[key])]
+                        self._remember(key, results[index])
+                        self.counters["disk_hits"] += 1
+
+            self.counters["misses"] += sum(i is None for i in results)
+
+            return results
+
+    def update(self, entries: dict[str, Entry]):
+        """Store `entries` in both the memory and the disk tier."""
+        with self.access:
+            for key, entry in entries.items():
+                self._remember(key, entry)
+
+            if self.disk is not None:
+                self.disk.executemany(
+                    "INSERT OR REPLACE INTO generation VALUES (?, ?)",
+                    ((key, json.dumps(entry)) for key, entry in entries.items()))
+                self.disk.commit()
+
+    def stats(self) -> dict[str, int]:
+        with self.access:
+            return {**self.counters, "memory_size": len(self.memory)}
+
+    def _remember(self, key: str, entry: Entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+
+class EncoderCache:
+    """Bounded LRU cache of encoder states, keyed by the exact prompt.
+
+    Values are opaque (unpadded state tensors on the model's device), sized by
+    their first dimension; `capacity` bounds the total number of cached tokens
+    rather than the number of entries.
+    """
+
+    def __init__(self, capacity: int):
+        self.access: Lock = Lock()
+
+        self.capacity: int = capacity
+        self.memory: OrderedDict[Hashable, object] = OrderedDict()
+        self.size: int = 0
+
+        self.counters: dict[str, int] = {
+            "hits": 0, "misses": 0, "hit_tokens": 0, "miss_tokens": 0}
+
+    def lookup(self, keys: list[Hashable]) -> list[Optional[object]]:
+        """Look up `keys`, returning `None` for every key not cached."""
+        with self.access:
+            results = []
+            for key in keys:
+                if (entry := self.memory.get(key)) is not None:
+                    self.memory.move_to_end(key)
+                    self.counters["hits"] += 1
+                    self.counters["hit_tokens"] += len(entry)
+                else:
+                    self.counters["misses"] += 1
+                results.append(entry)
+
+            return results
+
+    def update(self, entries: dict[Hashable, object]):
+        with self.access:
+            for key, entry in entries.items():
+                self.counters["miss_tokens"] += len(entry)
+                if key in self.memory:
+                    self.size -= len(self.memory.pop(key))
+
+                self.memory[key] = entry
+                self.size += len(entry)
+
+            while self.size > self.capacity and self.memory:
+                self.size -= len(self.memory.popitem(last=False)[1])
+
+    def stats(self) -> dict[str, int]:
+        with self.access:
+            return {**self.counters, "entries": len(self.memory), "tokens": self.size}
@@ -0,0 +1,83 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import zlib
+from typing import Hashable, Optional
+
+import numpy as np
+
+PRIME = (1 << 61) - 1  # modulus of the universal hash family
+
+
+def shingles(text: str, size: int = 3) -> set[str]:
+    """Returns the character `size`-grams of `text` (padded with spaces)."""
+    text = f" {text} "
+    return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+
+class MinHashIndex:
+    """Near-duplicate lookup of short texts by MinHash locality sensitive hashing.
+
+    Texts are compared by the Jaccard similarity of their character trigrams.
+    Each text gets a signature of `bands * rows` MinHash values, and texts
+    sharing all `rows` values of any band are candidates, whose similarity is
+    then computed exactly. Texts similar enough to be found with a reasonable
+    probability fall around `(1 / bands) ** (1 / rows)` and above, so the
+    defaults suit thresholds around 0.5 to 0.9.
+
+    Parameters
+    ----------
+    threshold : float
+        The smallest Jaccard similarity of near-duplicates.
+    bands : int
+        The number of LSH bands.
+    rows : int
+        The number of MinHash values per band.
+    seed : int
+        The seed of the hash family, indexes built with the same seed agree.
+    """
+
+    def __init__(self, threshold: float, bands: int = 16, rows: int = 4, seed: int = 0):
+        self.threshold: float = threshold
+        self.bands: int = bands
+        self.rows: int = rows
+
+        random = np.random.default_rng(seed)
+        # 32 bit coefficients keep `a * x + b` of 32 bit hashes below 2 ** 64
+        self.a: np.ndarray = random.integers(1, 1 << 32, bands * rows, dtype=np.uint64)
+        self.b: np.ndarray = random.integers(0, 1 << 32, bands * rows, dtype=np.uint64)
+
+        self.buckets: dict[tuple[int, bytes], list[Hashable]] = {}
+        self.sets: dict[Hashable, set[str]] = {}
+
+    def signature(self, grams: set[str]) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(i.encode()) for i in grams), np.uint64, len(grams))
+        return ((np.multiply.outer(hashes, self.a) + self.b) % np.uint64(PRIME)).min(axis=0)
+
+    def bucket_keys(self, grams: set[str]) -> list[tuple[int, bytes]]:
+        bands = self.signature(grams).reshape(self.bands, self.rows)
+        return [(band, values.tobytes()) for band, values in enumerate(bands)]
+
+    def lookup(self, text: str) -> Optional[Hashable]:
+        """Returns the key of the most similar indexed text at or above the
+        threshold, if any."""
+        grams = shingles(text)
+
+        best, similarity = None, self.threshold
+        for bucket in self.bucket_keys(grams):
+            for key in self.buckets.get(bucket, ()):
+                other = self.sets[key]
+                if (current := len(grams & other) / len(grams | other)) >= similarity:
+                    best, similarity = key, current
+
+        return best
+
+    def add(self, text: str, key: Hashable):
+        grams = shingles(text)
+
+        self.sets[key] = grams
+        for bucket in self.bucket_keys(grams):
+            self.buckets.setdefault(bucket, []).append(key)
@@ -0,0 +1,140 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""The reasoning engine, served in process or from a separate process.
+
+By default `server.py` runs the engine inside its own process. For production
+serving, run the engine once as a long-lived process and point any number of
+HTTP workers at it over local IPC (a `multiprocessing` manager), so the HTTP
+layer scales separately from the model workers and stays responsive:
+
+    export HAICOR_ENGINE_KEY=$(python -c "import secrets; print(secrets.token_hex())")
+    HAICOR_ENGINE=127.0.0.1:5100 python engine.py
+    HAICOR_ENGINE=127.0.0.1:5100 gunicorn --workers 4 --threads 16 server:app
+
+`HAICOR_ENGINE` is a `host:port` pair or a Unix socket path, and both sides
+must share the secret `HAICOR_ENGINE_KEY`. The engine unpickles what its
+clients send, so anyone holding the key can run code in the engine's process:
+keep it secret, and keep the address unreachable from untrusted networks.
+"""
+from __future__ import annotations
+
+import os
+import secrets
+from multiprocessing.managers import BaseManager
+from typing import Optional, Union
+
+ENGINE_ADDRESS = os.environ.get("HAICOR_ENGINE", "")  # empty means in process
+ENGINE_KEY = os.environ.get("HAICOR_ENGINE_KEY", "").encode()  # required with an address
+MINIMUM_KEY_LENGTH = 16
+
+
+class Engine:
+    """Everything the HTTP layer asks of the model batcher and the reasoner.
+
+    Creating an engine starts the batcher and reasoner threads of `thread.py`.
+    Every method takes and returns plain (picklable) values, so an engine can
+    be used through a manager proxy, see `serve` and `connect`.
+    """
+
+    def __init__(self):
+        # imported here, the models are only loaded by the engine's process
+        from metrics import METRICS
+        from reason import CACHE, ENCODERS
+        from thread import STORE, batcher, reasoner
+
+        self.batcher, self.reasoner = batcher, reasoner
+        self.cache, self.store, self.encoders = CACHE, STORE, ENCODERS
+        self.aggregate = METRICS
+
+        self.batcher.start()
+        self.reasoner.start()
+
+    def submit_step(self, usage: str, order: str, aspect: str, context: list[str], question: str, total: int) -> str:
+        return self.reasoner.submit_step(usage, order, aspect, context, question, total)
+
+    def submit_path(self, source: str, target: str, context: list[str], length: int, branch: int, total: int, **options) -> str:
+        """Submit a path job, `options` are the optional `candidates`, `width`,
+        and `interleave` of `Reasoner.submit_path`."""
+        return self.reasoner.submit_path(source, target, context, length, branch, total, **options)
+
+    def submit_graph(self, target: str, context: list[str], length: int, branch: int, total: int, **options) -> str:
+        return self.reasoner.submit_graph(target, context, length, branch, total, **options)
+
+    def status(self, uuid: str) -> str:
+        return self.reasoner.status(uuid)
+
+    def watch(self, uuid: str, version: Optional[int], timeout: float, offsets: Optional[dict[str, int]] = None) -> tuple[int, str, dict]:
+        return self.reasoner.watch(uuid, version, timeout, offsets)
+
+    def obtain_result(self, uuid: str) -> list:
+        return self.reasoner.obtain_result(uuid)
+
+    def cancel(self, uuid: str) -> bool:
+        return self.reasoner.cancel(uuid)
+
+    def instrumentation(self, uuid: str) -> Optional[dict]:
+        return self.reasoner.instrumentation(uuid)
+
+    def stats(self) -> dict:
+        return {**self.reasoner.stats(), "batching": self.batcher.stats()}
+
+    def cache_stats(self) -> dict:
+        return {**self.cache.stats(), "graphs": self.store.stats(),
+                "encoder": self.encoders.stats()}
+
+    def metrics(self) -> dict:
+        from metrics import peaks
+
+        snapshot = self.aggregate.snapshot()
+        snapshot["memory"].update(peaks())
+
+        return snapshot
+
+
+class EngineManager(BaseManager):
+    pass
+
+
+def address(value: str) -> Union[tuple[str, int], str]:
+    """Parse a `host:port` pair or a Unix socket path."""
+    if ":" not in value:
+        return value
+
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
+
+
+def authkey(key: bytes) -> bytes:
+    """Returns `key` if it is long enough to authenticate engine connections,
+    raises `ValueError` otherwise (such as when `HAICOR_ENGINE_KEY` is unset)."""
+    if len(key) < MINIMUM_KEY_LENGTH:
+        raise ValueError(f"HAICOR_ENGINE_KEY must be a secret of at least {MINIMUM_KEY_LENGTH} "
+                         f"characters, such as {secrets.token_hex()}")
+
+    return key
+
+
+def serve(location: str, key: bytes = ENGINE_KEY):
+    """Run an engine and serve it at `location` until interrupted."""
+    key = authkey(key)  # before loading any model
+    engine = Engine()
+    EngineManager.register("engine", callable=lambda: engine)
+
+    manager = EngineManager(address=address(location), authkey=key)
+    manager.get_server().serve_forever()
+
+
+def connect(location: str, key: bytes = ENGINE_KEY) -> Engine:
+    """Connect to the engine served at `location`, returns its proxy."""
+    EngineManager.register("engine")
+
+    manager = EngineManager(address=address(location), authkey=authkey(key))
+    manager.connect()
+
+    return manager.engine()
+
+
+if __name__ == "__main__":
+    serve(ENGINE_ADDRESS or "127.0.0.1:5100")
@@ -0,0 +1,291 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import io
+import json
+import sys
+from typing import Optional
+
+import networkx as nx
+import numpy as np
+
+from paths import PathIndex
+from reason import prompt
+
+ASPECTS = ["causal", "emotional", "spatial", "possession", "miscellaneous"]
+KINDS = ["source", "middle", "target"]
+
+# the aspect of an edge also records how its prompt is built
+LABELS = ASPECTS + ["entailment"]
+FORWARD, BACKWARD, ENTAILMENT = 0, 1, 2
+
+COLUMNS = ["kinds", "texts", "probabilities", "alive", "sources", "targets",
+           "directions", "aspects", "results", "scores"]
+
+
+class Column:
+    """A growable one dimensional numpy array."""
+
+    def __init__(self, dtype: type):
+        self.data: np.ndarray = np.zeros(64, dtype)
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index):
+        return self.data[:self.size][index]
+
+    def __setitem__(self, index, value):
+        self.data[:self.size][index] = value
+
+    def append(self, value) -> int:
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros_like(self.data)])
+
+        self.data[self.size] = value
+        self.size += 1
+
+        return self.size - 1
+
+    def extend(self, values: np.ndarray):
+        if self.size + len(values) > len(self.data):
+            capacity = max(2 * len(self.data), self.size + len(values))
+            self.data = np.concatenate(
+                [self.data[:self.size], np.zeros(capacity - self.size, self.data.dtype)])
+
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    @property
+    def array(self) -> np.ndarray:
+        return self.data[:self.size]
+
+
+class Strings:
+    """An interned string table, every distinct string is stored once."""
+
+    def __init__(self):
+        self.values: list[str] = []
+        self.index: dict[str, int] = {}
+
+    def __getitem__(self, index: int) -> str:
+        return self.values[index]
+
+    def intern(self, value: str) -> int:
+        if (index := self.index.get(value)) is None:
+            index = self.index[value] = len(self.values)
+            self.values.append(value)
+
+        return index
+
+
+class ReasoningGraph:
+    """A directed reasoning graph with integer node ids and columnar storage.
+
+    Node kinds, texts, and cumulative probabilities as well as edge endpoints,
+    aspects, results, and scores live in numpy columns; texts and results are
+    interned. Edge prompts are not stored at all, they are rebuilt on demand
+    from the story context, the edge's aspect, and the text of the node the
+    inference was made from.
+    """
+
+    def __init__(self, context: list[str]):
+        self.context: list[str] = context
+        self.strings: Strings = Strings()
+
+        # node columns
+        self.kinds: Column = Column(np.int8)
+        self.texts: Column = Column(np.int32)
+        self.probabilities: Column = Column(np.float64)
+        self.alive: Column = Column(np.bool_)
+
+        # edge columns
+        self.sources: Column = Column(np.int32)
+        self.targets: Column = Column(np.int32)
+        self.directions: Column = Column(np.int8)
+        self.aspects: Column = Column(np.int8)
+        self.results: Column = Column(np.int32)
+        self.scores: Column = Column(np.float64)
+        self.edges: dict[int, int] = {}  # (source << 32 | target) to edge id
+
+    # ================================== NODES ===================================
+    def add_node(self, kind: str, text: str, probability: float = 1.0) -> int:
+        self.kinds.append(KINDS.index(kind))
+        self.texts.append(self.strings.intern(text))
+        self.probabilities.append(probability)
+
+        return self.alive.append(True)
+
+    def remove_nodes(self, nodes: list[int]):
+        """Remove `nodes` and, implicitly, every edge touching them."""
+        self.alive[nodes] = False
+
+    def kind(self, node: int) -> str:
+        return KINDS[self.kinds[node]]
+
+    def text(self, node: int) -> str:
+        return self.strings[self.texts[node]]
+
+    def number_of_nodes(self) -> int:
+        return int(self.alive.array.sum())
+
+    # ================================== EDGES ===================================
+    def add_edge(self, source: int, target: int, direction: int, aspect: str, result: str, score: float) -> int:
+        """Add (or replace) the `source` to `target` edge.
+
+        `direction` tells which endpoint the inference was made from: `FORWARD`
+        edges from `source`, `BACKWARD` edges from `target`, and `ENTAILMENT`
+        edges from both (as premise and hypothesis).
+        """
+        if (edge := self.edge(source, target)) is None:
+            edge = self.sources.append(source)
+            self.targets.append(target)
+            self.directions.append(direction)
+            self.aspects.append(0)
+            self.results.append(0)
+            self.scores.append(0.0)
+
+            self.edges[int(source) << 32 | int(target)] = edge
+
+        self.directions[edge] = direction
+        self.aspects[edge] = LABELS.index(aspect)
+        self.results[edge] = self.strings.intern(result)
+        self.scores[edge] = score
+
+        return edge
+
+    def edge(self, source: int, target: int) -> Optional[int]:
+        return self.edges.get(int(source) << 32 | int(target))
+
+    def aspect(self, edge: int) -> str:
+        return LABELS[self.aspects[edge]]
+
+    def result(self, edge: int) -> str:
+        return self.strings[self.results[edge]]
+
+    def prompt(self, edge: int) -> str:
+        source, target = int(self.sources[edge]), int(self.targets[edge])
+
+        if (direction := self.directions[edge]) == ENTAILMENT:
+            return f"mnli hypothesis: {self.text(target)} premise: {self.text(source)}"
+
+        node = source if direction == FORWARD else target
+        usage = "general" if self.kind(node) == "source" else "premise"
+        order = "forward" if direction == FORWARD else "backward"
+
+        return prompt(usage, order, self.aspect(edge), self.context, self.text(node))
+
+    def live_edges(self) -> np.ndarray:
+        alive = self.alive.array
+        return np.flatnonzero(alive[self.sources.array] & alive[self.targets.array])
+
+    def number_of_edges(self) -> int:
+        return len(self.live_edges())
+
+    # ================================== PATHS ===================================
+    def path_index(self, sources: list[int]) -> PathIndex:
+        edges = self.live_edges()
+        return PathIndex(list(range(len(self.alive))),
+                         self.sources.array[edges].astype(np.int64),
+                         self.targets.array[edges].astype(np.int64),
+                         self.scores.array[edges], sources)
+
+    def describe(self, path: list[int]) -> tuple[float, list[str]]:
+        """Returns the score (product of edge scores) and the texts of `path`."""
+        score, result = 1, [self.text(path[0])]
+        for source, target in zip(path, path[1:]):
+            edge = self.edge(source, target)
+            score *= float(self.scores[edge])
+
+            result.append(self.result(edge))
+            result.append(self.text(target))
+
+        return score, result
+
+    # ================================== EXPORT ==================================
+    def to_networkx(self) -> nx.DiGraph:
+        """Export as a `networkx.DiGraph` with integer nodes and the attributes
+        (`kind`, `text`, `probability`, `aspect`, `prompt`, `result`, `score`)
+        used by the original representation."""
+        graph = nx.DiGraph(context=self.context)
+
+        graph.add_nodes_from(
+            (node, {"kind": self.kind(node),
+                    "text": self.text(node),
+                    "probability": float(self.probabilities[node])})
+            for node in np.flatnonzero(self.alive.array).tolist())
+        graph.add_edges_from(
+            (int(self.sources[edge]), int(self.targets[edge]),
+             {"aspect": self.aspect(edge),
+              "prompt": self.prompt(edge),
+              "result": self.result(edge),
+              "score": float(self.scores[edge])})
+            for edge in self.live_edges().tolist())
+
+        return graph
+
+    def merge(self, other: ReasoningGraph) -> int:
+        """Copy every node and edge of `other` (with the same context) into this
+        graph. Node `i` of `other` becomes node `offset + i`, and `offset` is
+        returned."""
+        offset = len(self.alive)
+        strings = np.array([self.strings.intern(i) for i in other.strings.values], np.int32)
+
+        self.kinds.extend(other.kinds.array)
+        self.texts.extend(strings[other.texts.array])
+        self.probabilities.extend(other.probabilities.array)
+        self.alive.extend(other.alive.array)
+
+        first = len(self.sources)
+        self.sources.extend(other.sources.array + offset)
+        self.targets.extend(other.targets.array + offset)
+        self.directions.extend(other.directions.array)
+        self.aspects.extend(other.aspects.array)
+        self.results.extend(strings[other.results.array])
+        self.scores.extend(other.scores.array)
+
+        for edge in range(first, len(self.sources)):
+            self.edges[int(self.sources[edge]) << 32 | int(self.targets[edge])] = edge
+
+        return offset
+
+    # =============================== SERIALIZATION ==============================
+    def to_bytes(self) -> bytes:
+        """Serialize into a compressed `.npz` archive, see `from_bytes`."""
+        def encode(value):
+            return np.frombuffer(json.dumps(value).encode(), np.uint8)
+
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, context=encode(self.context),
+                            strings=encode(self.strings.values),
+                            **dict((name, getattr(self, name).array) for name in COLUMNS))
+
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> ReasoningGraph:
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            graph = cls(json.loads(archive["context"].tobytes()))
+            for value in json.loads(archive["strings"].tobytes()):
+                graph.strings.intern(value)
+
+            for name in COLUMNS:
+                getattr(graph, name).extend(archive[name])
+
+        for edge in range(len(graph.sources)):
+            graph.edges[int(graph.sources[edge]) << 32 | int(graph.targets[edge])] = edge
+
+        return graph
+
+    def nbytes(self) -> int:
+        """Approximate memory footprint in bytes (columns, strings, and index)."""
+        total = sum(getattr(self, name).data.nbytes for name in COLUMNS)
+        total += sum(sys.getsizeof(i) for i in self.strings.values)
+        total += sys.getsizeof(self.strings.values) + sys.getsizeof(self.strings.index)
+        total += sys.getsizeof(self.edges) + sum(sys.getsizeof(i) for i in self.edges)
+
+        return total
@@ -0,0 +1,109 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import resource
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Iterator
+
+import torch
+
+
+class Metrics:
+    """Counters, stage wall times, and memory use of a job (or of many).
+
+    Counters are summed (see `count`), stage times are summed per stage name
+    (see `time`), and memory keeps the highest use sampled (see `peak`, the
+    reasoner samples `memory` at every stage change of a job).
+    """
+
+    def __init__(self):
+        self.access: Lock = Lock()
+
+        self.counters: dict[str, float] = {}
+        self.stages: dict[str, float] = {}
+        self.peaks: dict[str, int] = {}
+
+    def count(self, **values: float):
+        with self.access:
+            for name, value in values.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def time(self, stage: str, seconds: float):
+        with self.access:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def peak(self, **values: int):
+        with self.access:
+            for name, value in values.items():
+                self.peaks[name] = max(self.peaks.get(name, 0), value)
+
+    def snapshot(self) -> dict:
+        """Returns the counters, the ratios derived from them, the stage times
+        (in seconds), and the highest memory use."""
+        with self.access:
+            counters, stages, peaks = dict(self.counters), dict(self.stages), dict(self.peaks)
+
+        def ratio(numerator, denominator):
+            return counters.get(numerator, 0) / (counters.get(denominator, 0) or 1)
+
+        counters.update(
+            padding_ratio=(counters.get("padding_tokens", 0)
+                           / ((counters.get("prompt_tokens", 0) + counters.get("padding_tokens", 0)) or 1)),
+            mean_batch_size=ratio("sequences", "model_batches"),
+            rejection_ratio=ratio("rejected", "inferences"),
+            duplication_ratio=(counters.get("duplicates", 0)
+                               / ((counters.get("inferences", 0) - counters.get("rejected", 0)) or 1)),
+            cache_hit_ratio=ratio("cache_hits", "prompts"))
+
+        return {"counters": counters, "stages": stages, "memory": peaks}
+
+
+def memory() -> dict[str, int]:
+    """Returns the current memory use of the process (where `/proc` tells it)
+    and of the current CUDA device."""
+    usage = {}
+    try:
+        with open("/proc/self/statm") as file:
+            usage["process_kilobytes"] = int(file.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        pass
+    if torch.cuda.is_available():
+        usage["device_bytes"] = torch.cuda.memory_allocated()
+
+    return usage
+
+
+def peaks() -> dict[str, int]:
+    """Returns the peak memory of the process and of the current CUDA device
+    over their lifetime (never reset, so not attributable to any one job)."""
+    usage = {"process_peak_kilobytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if torch.cuda.is_available():
+        usage["device_peak_bytes"] = torch.cuda.max_memory_allocated()
+
+    return usage
+
+
+LOCAL = local()  # the metrics the calling thread records into, see `recording`
+
+
+@contextmanager
+def recording(*metrics: Metrics) -> Iterator[None]:
+    """Add every `record` made by the calling thread to `metrics` as well."""
+    sinks = getattr(LOCAL, "sinks", ())
+    LOCAL.sinks = sinks + metrics
+    try:
+        yield
+    finally:
+        LOCAL.sinks = sinks
+
+
+def record(**values: float):
+    for metrics in getattr(LOCAL, "sinks", ()):
+        metrics.count(**values)
+
+
+METRICS = Metrics()  # aggregated over every job
@@ -0,0 +1,149 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+"""Offline batch reasoning over the ROCStories Dataset, without the web server.
+
+Stories are streamed from the dataset CSV file and turned into `step` jobs (one
+per sentence and aspect), `path` jobs (from the `--source` to the `--target`
+sentence), or `graph` jobs (towards the `--target` sentence), always with the
+whole story as context. Up to `--window` jobs are in flight at once and run on
+`--jobs` reasoner workers, so prompts from different stories share the model
+batches of the batcher.
+
+Every finished job is appended to the `--output` JSONL file as soon as it is
+done. The file starts with the run settings and doubles as the checkpoint: a
+killed run started again with the same settings skips every job already in
+the file. Failed jobs are reported and left out, so they run again as well.
+
+Run from the `backend` directory, e.g. `python offline.py graph --output
+graphs.jsonl`.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from itertools import islice
+from typing import Iterator
+
+from graph import ASPECTS
+from stories import read_stories
+from thread import CANDIDATES, INTERLEAVE, WIDTH, Reasoner, batcher
+
+
+def jobs(args: argparse.Namespace) -> Iterator[tuple[str, str, tuple]]:
+    """Yield the `(key, task, arguments)` of every job, in dataset order."""
+    for uuid, _, lines in islice(read_stories(args.stories), args.limit):
+        if args.task == "step":
+            for index, line in enumerate(lines):
+                for aspect in ASPECTS:
+                    yield (f"{uuid}/{index}/{aspect}", "step",
+                           (args.usage, args.order, aspect, lines, line, args.total))
+        elif args.task == "path":
+            yield (uuid, "path", (lines[args.source], lines[args.target], lines, args.length,
+                                  args.branch, args.total, args.candidates, args.width,
+                                  args.interleave))
+        elif args.task == "graph":
+            yield (uuid, "graph", (lines[args.target], lines, args.length, args.branch,
+                                   args.total, args.candidates, args.width))
+
+
+def resume(path: str, settings: dict) -> set[str]:
+    """Returns the keys of the jobs already in the output file at `path`.
+
+    A missing file (or one killed before its first line was written) is
+    created with the run `settings` as its first line. A partially written last
+    line (from a killed run) is dropped.
+    """
+    done, valid = set(), 0
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            for number, line in enumerate(file):
+                if not line.endswith(b"\n"):  # may still parse, e.g. a cut off number
+                    break
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if number == 0 and record.get("settings") != settings:
+                    sys.exit(f"{path} was written with other settings: {record.get('settings')}")
+
+                done.add(record.get("key"))
+                valid += len(line)
+
+    if valid == 0:
+        with open(path, "w") as file:
+            file.write(json.dumps({"settings": settings}) + "\n")
+        return set()
+
+    os.truncate(path, valid)
+    return done - {None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("task", choices=["step", "path", "graph"])
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--stories", default="./rocstory.csv")
+    parser.add_argument("--limit", type=int, help="the number of stories to reason about")
+    parser.add_argument("--usage", default="general", help="step jobs only")
+    parser.add_argument("--order", default="forward", help="step jobs only")
+    parser.add_argument("--source", type=int, default=0, help="path jobs only")
+    parser.add_argument("--target", type=int, default=4)
+    parser.add_argument("--length", type=int, default=2)
+    parser.add_argument("--branch", type=int, default=3)
+    parser.add_argument("--total", type=int, default=5)
+    parser.add_argument("--candidates", type=int, default=CANDIDATES)
+    parser.add_argument("--width", type=int, default=WIDTH)
+    parser.add_argument("--interleave", action="store_true", default=INTERLEAVE,
+                        help="path jobs only, see `Reasoner.interleave_path`")
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--window", type=int, default=64, help="the jobs in flight")
+    args = parser.parse_args()
+
+    settings = dict((key, value) for key, value in vars(args).items()
+                    if key not in ("output", "limit", "jobs", "window"))
+    done = resume(args.output, settings)
+
+    reasoner = Reasoner(args.jobs, retained=args.window)
+    batcher.start()
+    reasoner.start()
+
+    pending = ((key, task, arguments) for key, task, arguments in jobs(args) if key not in done)
+    flight, written, start = {}, 0, time.monotonic()
+    try:
+        with open(args.output, "a") as file:
+            while True:
+                while len(flight) < args.window and (job := next(pending, None)) is not None:
+                    key, task, arguments = job
+                    flight[getattr(reasoner, f"submit_{task}")(*arguments)] = key
+
+                if not flight:
+                    break
+
+                for uuid in reasoner.wait_any(list(flight), 60):
+                    key = flight.pop(uuid)
+                    if reasoner.status(uuid) == "error":  # not written, runs again on resume
+                        _, _, partial = reasoner.watch(uuid, None, 0)
+                        reasoner.obtain_result(uuid)
+                        print(f"{key} failed: {partial.get('error')}", file=sys.stderr)
+                        continue
+
+                    record = {"key": key, "result": reasoner.obtain_result(uuid)}
+                    file.write(json.dumps(record) + "\n")
+                    written += 1
+
+                file.flush()
+                print(f"{len(done) + written} jobs done, {written / (time.monotonic() - start):.2f} jobs/s",
+                      file=sys.stderr)
+    finally:
+        for uuid in flight:  # interrupted, these will run again on resume
+            reasoner.cancel(uuid)
+
+        reasoner.stop()
+        batcher.stop()
@@ -0,0 +1,136 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import heapq
+from typing import Hashable, Optional
+
+import networkx as nx
+import numpy as np
+
+
+class PathIndex:
+    """A compact, array backed view of a reasoning graph for path searches.
+
+    Edges are stored in compressed sparse row form with their weights already
+    converted to `-log(score)`, so the most likely (largest product of scores)
+    paths are the shortest ones. Node `len(nodes)` is a virtual super source
+    connected to every source node with zero weight edges, which turns multi
+    source searches into single source searches.
+    """
+
+    def __init__(self, nodes: list[Hashable], sources: np.ndarray, targets: np.ndarray, scores: np.ndarray, starts: list[int]):
+        self.nodes: list[Hashable] = nodes
+        self.origin: int = len(nodes)  # the virtual super source
+
+        # append the virtual edges and sort everything by source node
+        sources = np.concatenate([sources, np.full(len(starts), self.origin)])
+        targets = np.concatenate([targets, np.asarray(starts, dtype=np.int64)])
+        with np.errstate(divide="ignore"):
+            weights = np.concatenate([np.maximum(-np.log(scores), 0.0),
+                                      np.zeros(len(starts))])
+
+        order = np.argsort(sources, kind="stable")
+        counts = np.bincount(sources, minlength=len(nodes) + 1)
+
+        # plain lists, element access on them is much faster than on arrays
+        self.indptr: list[int] = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        self.indices: list[int] = targets[order].tolist()
+        self.weights: list[float] = weights[order].tolist()
+
+    @classmethod
+    def from_networkx(cls, graph: nx.DiGraph, sources: list[Hashable]) -> PathIndex:
+        nodes = list(graph.nodes)
+        index = dict((node, i) for i, node in enumerate(nodes))
+
+        edges = list(graph.edges(data="score"))
+        return cls(nodes,
+                   np.fromiter((index[u] for u, _, _ in edges), np.int64, len(edges)),
+                   np.fromiter((index[v] for _, v, _ in edges), np.int64, len(edges)),
+                   np.fromiter((s for _, _, s in edges), np.float64, len(edges)),
+                   [index[i] for i in sources])
+
+    def dijkstra(self, source: int, target: int, nodes: set[int], edges: set[tuple[int, int]]) -> Optional[tuple[float, list[int]]]:
+        """Shortest `source` to `target` path avoiding `nodes` and `edges`."""
+        indptr, indices, weights = self.indptr, self.indices, self.weights
+
+        distance, previous = {source: 0.0}, {}
+        queue, done = [(0.0, source)], set()
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if node in done:
+                continue
+            if node == target:
+                break
+            done.add(node)
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                child, weight = indices[edge], weights[edge]
+                if child in nodes or child in done or weight == np.inf or (node, child) in edges:
+                    continue
+
+                if cost + weight < distance.get(child, np.inf):
+                    distance[child] = cost + weight
+                    previous[child] = node
+                    heapq.heappush(queue, (cost + weight, child))
+        else:
+            return None
+
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+
+        return distance[target], path[::-1]
+
+    def cost(self, path: list[int]) -> float:
+        indptr, indices, weights = self.indptr, self.indices, self.weights
+
+        total = 0.0
+        for node, child in zip(path, path[1:]):
+            edges = range(indptr[node], indptr[node + 1])
+            total += min(weights[i] for i in edges if indices[i] == child)
+
+        return total
+
+    def shortest_paths(self, target: Hashable, total: int) -> list[list[Hashable]]:
+        """Find the `total` shortest loopless paths from any source to `target`.
+
+        This is Yen's algorithm: every next path is the best deviation, at some
+        spur node, from the paths found so far.
+
+        Returns
+        -------
+        list[list[Hashable]]
+            Up to `total` paths (as lists of graph nodes) sorted from the most
+            to the least likely.
+        """
+        target = self.nodes.index(target)
+
+        if total <= 0 or (first := self.dijkstra(self.origin, target, set(), set())) is None:
+            return []
+
+        found, candidates, seen = [first[1]], [], {tuple(first[1])}
+        while len(found) < total:
+            last = found[-1]
+            for i in range(len(last) - 1):
+                spur, root = last[i], last[:i + 1]
+
+                # forbid the deviations already taken from this root path
+                edges = set((path[i], path[i + 1]) for path in found
+                            if len(path) > i + 1 and path[:i + 1] == root)
+                if (deviation := self.dijkstra(spur, target, set(root[:-1]), edges)) is None:
+                    continue
+
+                path = root[:-1] + deviation[1]
+                if tuple(path) not in seen:
+                    seen.add(tuple(path))
+                    heapq.heappush(candidates, (self.cost(root) + deviation[0], path))
+
+            if not candidates:
+                break
+            found.append(heapq.heappop(candidates)[1])
+
+        # drop the virtual super source
+        return [[self.nodes[i] for i in path[1:]] for path in found]
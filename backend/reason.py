@@ -4,23 +4,186 @@
 # https://opensource.org/licenses/MIT
 from __future__ import annotations
 
+import logging
+import os
+from contextlib import nullcontext
 from functools import singledispatch
-from itertools import chain, repeat
+from threading import Lock, local
+from typing import ContextManager
 
 import numpy as np
 import torch
 from transformers import T5ForConditionalGeneration, T5Tokenizer
+from transformers.modeling_outputs import BaseModelOutput
+
+from cache import EncoderCache, GenerationCache, checkpoint_identity
+from metrics import record
 
 # =================================== MODELS ===================================
-cs_token = T5Tokenizer.from_pretrained("./checkpoint")
-cs_model = T5ForConditionalGeneration.from_pretrained("./checkpoint")
-cs_model.to("cuda")  # this model is used for commonsense knowledge
+CS_CHECKPOINT = "./checkpoint"  # this model is used for commonsense knowledge
+T5_CHECKPOINT = "t5-small"  # this model is used for natural language inference
+
+DEVICE = os.environ.get("HAICOR_DEVICE") or (
+    "cuda" if torch.cuda.is_available() else "cpu")
+CPU_MODE = os.environ.get("HAICOR_CPU_MODE", "fp32")  # `fp32`, `int8`, or `bf16`
+COMPILE = os.environ.get("HAICOR_COMPILE", "")  # ``, `compile`, or `trace`, see `Model`
+CPU_THREADS = int(os.environ.get("HAICOR_CPU_THREADS", 0))  # 0 means default
+
+
+LOCAL = local()  # the model replica each thread is bound to, see `bind`
+
+
+def bind(device: str, replica: int = 0):
+    """Bind the calling thread to model replica `replica` on `device`.
+
+    Every `generate` call made from the calling thread afterwards will use this
+    replica. Threads that never call `bind` share replica `0` on `DEVICE`.
+    """
+    LOCAL.device, LOCAL.replica = device, replica
+
+
+def binding() -> tuple[str, int]:
+    return getattr(LOCAL, "device", DEVICE), getattr(LOCAL, "replica", 0)
+
+
+class Model:
+    """A language model and its tokenizer, loaded lazily on first use.
+
+    Replicas are identified by `(device, replica)` pairs and loaded the first
+    time they are asked for. Replicas on CPU run in `cpu_mode`: `fp32` (the
+    default) keeps the checkpoint weights as they are, `int8` applies dynamic
+    quantization to every linear layer, `bf16` runs the model under bfloat16
+    autocast (see `autocast`). The encoder of every replica is compiled with
+    `torch.compile` when `compile` is `compile` (PyTorch 2 and later, older
+    versions fall back to `trace`), or traced with `torch.jit.trace` into
+    TorchScript when it is `trace` (see `TracedEncoder`); beam search keeps
+    running the decoder eagerly. Modes other than `fp32` change the results
+    (`int8` noticeably), so they are part of the generation cache settings
+    (see `mode`); check them with `benchmarks.execution_modes` before use.
+    """
+
+    def __init__(self, checkpoint: str, cpu_mode: str = CPU_MODE, compile: str = COMPILE):
+        self.access: Lock = Lock()
+
+        self.checkpoint: str = checkpoint
+        self.identity: str = checkpoint_identity(checkpoint)
+        self.replicas: dict[tuple[str, int], tuple[T5Tokenizer, T5ForConditionalGeneration]] = {}
+
+        self.cpu_mode: str = cpu_mode
+        if compile not in ("", "compile", "trace"):
+            raise ValueError(f"unknown compile mode {compile!r}")
+        if compile == "compile" and not hasattr(torch, "compile"):
+            logging.warning("torch.compile needs PyTorch 2, tracing the encoders of %s instead "
+                            "(PyTorch %s)", checkpoint, torch.__version__)
+            compile = "trace"
+
+        self.compile: str = compile  # as actually applied
+
+    def mode(self, device: str) -> str:
+        mode = self.cpu_mode if device.startswith("cpu") else "fp32"
+        return f"{mode}+{self.compile}" if self.compile else mode
+
+    def load(self, device: str, replica: int = 0) -> tuple[T5Tokenizer, T5ForConditionalGeneration]:
+        with self.access:
+            if (device, replica) in self.replicas:
+                return self.replicas[device, replica]
+
+            token = T5Tokenizer.from_pretrained(self.checkpoint)
+            model = T5ForConditionalGeneration.from_pretrained(self.checkpoint)
+            model.eval()
+            model.to(device)
+
+            if device.startswith("cpu"):
+                if CPU_THREADS > 0:
+                    torch.set_num_threads(CPU_THREADS)
+                if self.cpu_mode == "int8":
+                    model = torch.quantization.quantize_dynamic(
+                        model, {torch.nn.Linear}, dtype=torch.qint8)
+                elif self.cpu_mode == "bf16":
+                    AUTOCAST[id(model)] = torch.bfloat16
+
+            if self.compile == "compile":  # shapes vary with every batch
+                model.encoder = torch.compile(model.encoder, dynamic=True)
+            elif self.compile == "trace":
+                model.encoder = TracedEncoder(token, model)
+
+            self.replicas[device, replica] = (token, model)
+
+            return token, model
+
+
+class EncoderStates(torch.nn.Module):
+    """The encoder states alone of `encoder`, in a form `torch.jit.trace` takes."""
+
+    def __init__(self, encoder: torch.nn.Module):
+        super().__init__()
+        self.encoder: torch.nn.Module = encoder
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class TracedEncoder(torch.nn.Module):
+    """The encoder of `model` traced into TorchScript, for PyTorch 1.
+
+    Only `input_ids` and `attention_mask` are passed to the traced encoder,
+    which is all `encode` and `embed` use, and the states are returned as a
+    `BaseModelOutput`. The trace is checked against a batch of another shape
+    so that it does not depend on the shapes it was traced with. Other
+    attributes are those of the original encoder, as `generate` inspects them.
+    """
+
+    def __init__(self, token: T5Tokenizer, model: T5ForConditionalGeneration):
+        super().__init__()
+        self.encoder: torch.nn.Module = model.get_encoder()
 
-t5_token = T5Tokenizer.from_pretrained("t5-small")
-t5_model = T5ForConditionalGeneration.from_pretrained("t5-small")
-t5_model.to("cuda")  # this model is used for natural language inference
+        example, check = (token(i, padding=True, return_tensors="pt").to(model.device)
+                          for i in (["a short prompt", "a longer prompt to pad the other"],
+                                    ["another prompt of other length"] * 3))
+        with torch.no_grad():  # `encode` and `embed` run the trace under `autocast`
+            self.traced: torch.jit.ScriptModule = torch.jit.trace(
+                EncoderStates(self.encoder), (example.input_ids, example.attention_mask),
+                check_inputs=[(check.input_ids, check.attention_mask)])
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, **kwargs) -> BaseModelOutput:
+        return BaseModelOutput(last_hidden_state=self.traced(input_ids, attention_mask))
+
+    def __getattr__(self, name: str):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.encoder, name)
+
+
+AUTOCAST: dict[int, torch.dtype] = {}  # autocast data types of replicas, by `id`
+
+
+def autocast(model: T5ForConditionalGeneration) -> ContextManager:
+    """Returns the autocast context `model` runs under, if any."""
+    if (dtype := AUTOCAST.get(id(model))) is None:
+        return nullcontext()
+
+    return torch.autocast(model.device.type, dtype=dtype)
+
+
+MODELS = {"glucose": Model(CS_CHECKPOINT), "mnli": Model(T5_CHECKPOINT)}
 # =================================== MODELS ===================================
 
+# =================================== CACHES ===================================
+CACHE_PATH = os.environ.get("HAICOR_CACHE_PATH", "./generation.sqlite3")
+CACHE_SIZE = int(os.environ.get("HAICOR_CACHE_SIZE", 65536))
+
+CACHE = GenerationCache(CACHE_PATH, CACHE_SIZE)
+
+# encoder states of recent prompts, in tokens (0 disables the cache); exact
+# repeats are served by `CACHE`, so states are only reused by prompts queried
+# again for another number of results (such as the step view of a story before
+# a search over it with another branching factor), see `benchmarks.encoder_flops`
+ENCODER_CACHE_SIZE = int(os.environ.get("HAICOR_ENCODER_CACHE_SIZE", 0))
+
+ENCODERS = EncoderCache(ENCODER_CACHE_SIZE)
+# =================================== CACHES ===================================
+
 
 # ================================== UTILITY ===================================
 def prompt(usage: str, order: str, aspect: str, context: list[str], question: str) -> str:
@@ -61,7 +224,14 @@ def prompt(usage: str, order: str, aspect: str, context: list[str], question: st
 # ================================ MODEL QUERY =================================
 BRANCHING_FACTOR = 1.5
 GENERATION_LENGTH = 128
-MAXIMUM_BATCH_SIZE = 256
+MAXIMUM_BATCH_SIZE = 256  # in generated sequences
+PROMPT_LENGTH = 512  # in tokens, longer prompts are truncated
+TOKEN_BUDGET = int(os.environ.get("HAICOR_TOKEN_BUDGET", 65536))  # in tokens
+
+# single result `mnli` prompts are classified by scoring every label instead of
+# running beam search, unless `HAICOR_MNLI_MODE` is `generate`
+MNLI_LABELS = ["entailment", "neutral", "contradiction"]
+MNLI_MODE = os.environ.get("HAICOR_MNLI_MODE", "classify")  # or `generate`
 
 
 @singledispatch
@@ -85,43 +255,17 @@ def _(input: str, number: int) -> list[tuple[str, str, float]]:
     list[tuple[str, str, float]]
         A list of `(prompt, result, score)` tuples.
     """
-    if input.startswith("glucose:"):
-        token, model = cs_token, cs_model
-    else:
-        token, model = t5_token, t5_model
-
-    # query language model
-    input_ids = token(
-        input,
-        padding=True,
-        truncation=True,
-        max_length=len(input),
-        return_tensors="pt").input_ids.to("cuda")
-    generated = model.generate(
-        input_ids=input_ids,
-        max_length=GENERATION_LENGTH,
-        num_beams=int(np.ceil(BRANCHING_FACTOR * number)),
-        num_return_sequences=number,
-        output_scores=True,
-        return_dict_in_generate=True
-    )
-
-    # convert and cleanup
-    texts = token.batch_decode(generated.sequences, skip_special_tokens=True)
-    scores = [i.item() for i in np.exp(generated.sequences_scores.cpu())]
-    results = list(map(tuple, zip(repeat(input, number), texts, scores)))
-
-    del input_ids
-    del generated
-    torch.cuda.empty_cache()
-
-    return results
+    return generate([input], number)
 
 
 @generate.register(list)
 def _(input: list[str], number: int) -> list[tuple[str, str, float]]:
     """Generate `number` number of inferences for each `input` prompt.
 
+    Results are served from `CACHE` whenever possible, only the prompts missing
+    from the cache are sent to the language model. Single inferences for `mnli`
+    prompts are made by `classify` (see `MNLI_MODE`).
+
     Parameters
     ----------
     input : list[str]
@@ -134,44 +278,270 @@ def _(input: list[str], number: int) -> list[tuple[str, str, float]]:
     list[tuple[str, str, float]]
         A list of `(prompt, result, score)` tuples.
     """
-    if len(input) > MAXIMUM_BATCH_SIZE:  # breaks large query into batches
-        BATCH_SIZE = int(np.floor(MAXIMUM_BATCH_SIZE / number)) or 1
-
-        inputs = range(0, len(input), BATCH_SIZE)
-        inputs = (input[i:i + BATCH_SIZE] for i in inputs)
+    if not input:
+        return []
 
-        return list(chain.from_iterable(generate(i, number) for i in inputs))
+    name = "glucose" if input[0].startswith("glucose:") else "mnli"
+    model, (device, replica) = MODELS[name], binding()
 
-    if input[0].startswith("glucose:"):
-        token, model = cs_token, cs_model
+    if classifying := (name == "mnli" and number == 1 and MNLI_MODE == "classify"):
+        settings = ("classify", MNLI_LABELS, model.mode(device))
     else:
-        token, model = t5_token, t5_model
+        num_beams = int(np.ceil(BRANCHING_FACTOR * number))
+        settings = (number, num_beams, GENERATION_LENGTH, model.mode(device))
+
+    keys = [GenerationCache.key(model.identity, i, *settings) for i in input]
+
+    # query language model for cache misses only (each distinct prompt once)
+    entries = CACHE.lookup(keys)
+    missing = dict((key, i) for key, i, entry in zip(keys, input, entries)
+                   if entry is None)
+    record(prompts=len(input), cache_hits=sum(entry is not None for entry in entries))
+
+    if missing:
+        token, model = model.load(device, replica)
+        if classifying:
+            results = classify(token, model, list(missing.values()))
+        else:
+            results = query(token, model, list(missing.values()), number)
+        results = dict((key, [(result, score) for _, result, score in results[i:i + number]])
+                       for key, i in zip(missing, range(0, len(results), number)))
+        CACHE.update(results)
+
+        entries = [results[key] if entry is None else entry
+                   for key, entry in zip(keys, entries)]
+
+    return [(i, result, score) for i, entry in zip(input, entries)
+            for result, score in entry]
+
+
+def pack(encoded: list[list[int]], num_beams: int, number: int) -> list[list[int]]:
+    """Pack the indices of the `encoded` prompts, sorted by token length, into
+    batches holding at most `TOKEN_BUDGET` padded tokens (times `num_beams`)
+    and `MAXIMUM_BATCH_SIZE` sequences (`number` per prompt)."""
+    batches, batch = [], []
+    for index in sorted(range(len(encoded)), key=lambda i: len(encoded[i])):
+        size = len(batch) + 1  # the current prompt is the longest in batch
+        if batch and (size * num_beams * len(encoded[index]) > TOKEN_BUDGET
+                      or size * number > MAXIMUM_BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+
+        batch.append(index)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def encode_padded(model: T5ForConditionalGeneration, encoded: list[list[int]]) -> tuple[torch.Tensor, torch.Tensor]:
+    """Run the encoder over the tokenized prompts `encoded`, padded together.
+
+    Returns
+    -------
+    tuple[torch.Tensor, torch.Tensor]
+        The `(batch, length, hidden size)` encoder states and the attention
+        mask of the padded prompts.
+    """
+    ids = torch.nn.utils.rnn.pad_sequence(
+        [torch.tensor(i) for i in encoded], batch_first=True,
+        padding_value=model.config.pad_token_id).to(model.device)
+    lengths = [len(i) for i in encoded]
+    mask = (torch.arange(ids.shape[1])[None, :] < torch.tensor(lengths)[:, None]).long().to(model.device)
+
+    with torch.inference_mode(), autocast(model):
+        states = model.get_encoder()(input_ids=ids, attention_mask=mask).last_hidden_state
+
+    return states, mask
+
+
+def encode(model: T5ForConditionalGeneration, encoded: list[list[int]]) -> tuple[torch.Tensor, torch.Tensor]:
+    """Encode the tokenized prompts `encoded` into padded encoder states.
+
+    States are served from `ENCODERS` whenever possible. The encoder only runs,
+    in one batch, over the distinct prompts missing from the cache; the states
+    of unpadded positions do not depend on the padding, so cached states are
+    interchangeable with freshly computed ones. Without a cache (the default)
+    the states of the whole batch are returned as the encoder computed them.
+
+    Returns
+    -------
+    tuple[torch.Tensor, torch.Tensor]
+        The `(batch, length, hidden size)` encoder states and the attention
+        mask of the padded prompts.
+    """
+    if ENCODERS.capacity == 0:  # nothing to copy states out for
+        return encode_padded(model, encoded)
+
+    keys = [(id(model), tuple(i)) for i in encoded]
+    entries = ENCODERS.lookup(keys)
+    missing = dict((key, i) for key, i, entry in zip(keys, encoded, entries) if entry is None)
+
+    if missing:
+        states, _ = encode_padded(model, list(missing.values()))
+
+        results = dict((key, states[i, :len(ids)].clone())
+                       for i, (key, ids) in enumerate(missing.items()))
+        ENCODERS.update(results)
+
+        entries = [results[key] if entry is None else entry
+                   for key, entry in zip(keys, entries)]
+
+    lengths = torch.tensor([len(i) for i in entries])
+    mask = torch.arange(int(lengths.max()))[None, :] < lengths[:, None]
+
+    return (torch.nn.utils.rnn.pad_sequence(entries, batch_first=True),
+            mask.long().to(model.device))
+
+
+def query(token: T5Tokenizer, model: T5ForConditionalGeneration, input: list[str], number: int) -> list[tuple[str, str, float]]:
+    """Query `model` for `number` number of inferences for each `input` prompt.
+
+    Prompts are sorted by their token length and packed into batches holding at
+    most `TOKEN_BUDGET` padded tokens (times the number of beams), so prompts of
+    similar lengths are padded together. Beam search starts from the encoder
+    states of `encode`, shared with earlier queries of the same prompts.
+    Results are returned in input order.
+
+    Parameters
+    ----------
+    token : T5Tokenizer
+        The tokenizer of `model`.
+    model : T5ForConditionalGeneration
+        The language model to be queried.
+    input : list[str]
+        The prompts for the language model, all intended for `model`.
+    number : int
+        The total number of inferences to be made based on each `input` prompt.
+
+    Returns
+    -------
+    list[tuple[str, str, float]]
+        A list of `(prompt, result, score)` tuples.
+    """
+    num_beams = int(np.ceil(BRANCHING_FACTOR * number))
+    encoded = token(input, truncation=True, max_length=PROMPT_LENGTH).input_ids
 
     # query language model
-    input_ids = token(
-        input,
-        padding=True,
-        truncation=True,
-        max_length=max(map(len, input)),
-        return_tensors="pt").input_ids.to("cuda")
-    generated = model.generate(
-        input_ids=input_ids,
-        max_length=GENERATION_LENGTH,
-        num_beams=int(np.ceil(BRANCHING_FACTOR * number)),
-        num_return_sequences=number,
-        output_scores=True,
-        return_dict_in_generate=True
-    )
-
-    # convert and cleanup
-    texts = token.batch_decode(generated.sequences, skip_special_tokens=True)
-    scores = [i.item() for i in np.exp(generated.sequences_scores.cpu())]
-    prompts = chain.from_iterable(repeat(i, number) for i in input)
-    results = list(map(tuple, zip(prompts, texts, scores)))
-
-    del input_ids
-    del generated
-    torch.cuda.empty_cache()
-
-    return results
+    outputs = [None] * len(input)
+    for batch in pack(encoded, num_beams, number):
+        states, mask = encode(model, [encoded[i] for i in batch])
+        record(model_batches=1, sequences=len(batch) * number,
+              prompt_tokens=int(mask.sum()), padding_tokens=int(mask.numel() - mask.sum()))
+
+        with torch.inference_mode(), autocast(model):  # beam search from the encoder states
+            generated = model.generate(
+                encoder_outputs=BaseModelOutput(last_hidden_state=states),
+                attention_mask=mask,
+                max_length=GENERATION_LENGTH,
+                num_beams=num_beams,
+                num_return_sequences=number,
+                output_scores=True,
+                return_dict_in_generate=True
+            )
+
+        record(generated_tokens=int((generated.sequences[:, 1:] != token.pad_token_id).sum()))
+
+        texts = token.batch_decode(generated.sequences, skip_special_tokens=True)
+        scores = np.exp(generated.sequences_scores.float().cpu().numpy()).tolist()
+        for offset, index in enumerate(batch):
+            outputs[index] = zip(texts[offset * number:(offset + 1) * number],
+                                 scores[offset * number:(offset + 1) * number])
+
+    return [(i, text, score) for i, output in zip(input, outputs)
+            for text, score in output]
+
+
+def classify(token: T5Tokenizer, model: T5ForConditionalGeneration, input: list[str]) -> list[tuple[str, str, float]]:
+    """Classify each `mnli` `input` prompt as one of `MNLI_LABELS`.
+
+    Instead of a beam search, every label (with its end of sequence token) is
+    scored by a single teacher forced decoder pass over the prompt's encoder
+    states, which are computed once and shared by all labels. The result is the
+    most likely label, and its score is the label's probability normalized over
+    `MNLI_LABELS`.
+
+    Parameters
+    ----------
+    token : T5Tokenizer
+        The tokenizer of `model`.
+    model : T5ForConditionalGeneration
+        The language model to be queried.
+    input : list[str]
+        The `mnli` prompts for the language model.
+
+    Returns
+    -------
+    list[tuple[str, str, float]]
+        A list of `(prompt, label, probability)` tuples.
+    """
+    labels = token(MNLI_LABELS, padding=True, return_tensors="pt").input_ids.to(model.device)
+    labels = labels.masked_fill(labels == token.pad_token_id, -100)
+    encoded = token(input, truncation=True, max_length=PROMPT_LENGTH).input_ids
+
+    outputs = [None] * len(input)
+    for batch in pack(encoded, len(MNLI_LABELS), len(MNLI_LABELS)):
+        states, mask = encode(model, [encoded[i] for i in batch])
+        record(model_batches=1, sequences=len(batch) * len(MNLI_LABELS),
+              prompt_tokens=int(mask.sum()), padding_tokens=int(mask.numel() - mask.sum()))
+
+        with torch.inference_mode(), autocast(model):
+            # pair every prompt with every label, sharing the encoder states
+            target = labels.repeat(len(batch), 1)
+            logits = model(encoder_outputs=(states.repeat_interleave(len(MNLI_LABELS), 0),),
+                           attention_mask=mask.repeat_interleave(len(MNLI_LABELS), 0),
+                           decoder_input_ids=model.prepare_decoder_input_ids_from_labels(target)).logits
+
+            scores = torch.log_softmax(logits.float(), dim=-1).gather(
+                -1, target.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+            scores = scores.masked_fill(target == -100, 0.0).sum(dim=-1)
+            scores = torch.softmax(scores.view(len(batch), len(MNLI_LABELS)), dim=-1)
+
+        best = scores.max(dim=-1)
+        for index, label, score in zip(batch, best.indices.tolist(), best.values.tolist()):
+            outputs[index] = (MNLI_LABELS[label], score)
+
+    return [(i, *output) for i, output in zip(input, outputs)]
+
+
 # ================================ MODEL QUERY =================================
+
+
+# =============================== MODEL EMBEDDING ==============================
+def embed(input: list[str], name: str = "mnli") -> np.ndarray:
+    """Embed each `input` text with the encoder of `MODELS[name]`.
+
+    The embedding of a text is the mean of its encoder states, normalized to
+    unit length, so the dot product of two embeddings is their cosine
+    similarity.
+
+    Parameters
+    ----------
+    input : list[str]
+        The texts to be embedded.
+    name : str
+        The name of the model whose encoder is used, `glucose` or `mnli`.
+
+    Returns
+    -------
+    np.ndarray
+        A `(len(input), hidden size)` array of embeddings.
+    """
+    token, model = MODELS[name].load(*binding())
+    record(embeddings=len(input))
+
+    outputs = []
+    for i in range(0, len(input), MAXIMUM_BATCH_SIZE):
+        encoded = token(input[i:i + MAXIMUM_BATCH_SIZE], padding=True, truncation=True,
+                        max_length=PROMPT_LENGTH, return_tensors="pt").to(model.device)
+        with torch.inference_mode(), autocast(model):
+            states = model.get_encoder()(input_ids=encoded.input_ids,
+                                         attention_mask=encoded.attention_mask).last_hidden_state
+
+        mask = encoded.attention_mask.unsqueeze(-1).to(states.dtype)
+        pooled = (states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        outputs.append(torch.nn.functional.normalize(pooled, dim=-1).float().cpu().numpy())
+
+    return np.concatenate(outputs) if outputs else np.zeros((0, model.config.d_model), np.float32)
+# =============================== MODEL EMBEDDING ==============================
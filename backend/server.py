@@ -2,23 +2,128 @@
 #
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
-import csv
+import hashlib
+import json
+from typing import Iterator
 
 from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 
-from thread import reasoner
+from engine import ENGINE_ADDRESS, Engine, connect
+from stories import StoryStore
 
 # ========================= LOADING ROCSTORIES DATASET =========================
-with open("./rocstory.csv", "r") as file:
-    reader = csv.reader(file)
-    assert len(next(reader)) == 7
-    STORIES = dict((uuid, content) for uuid, *content in reader)
+STORIES = StoryStore("./rocstory.csv", "./rocstory.sqlite3")
+STORY_PAGE_LIMIT = 5000  # the largest page `/api/story` serves
 # ========================= LOADING ROCSTORIES DATASET =========================
 
+# ============================ THE REASONING ENGINE ============================
+# in this process, or a separate one shared by every HTTP worker (see engine.py)
+engine = connect(ENGINE_ADDRESS) if ENGINE_ADDRESS else Engine()
+# ============================ THE REASONING ENGINE ============================
+
 app = Flask(__name__, static_url_path="/", static_folder="../frontend/build")
 CORS(app)
 
+STREAM_KEEPALIVE = 15  # seconds between keep-alive comments on idle streams
+APPENDED = ("edges",)  # `thread.APPENDED`, the engine may live in another process
+
+
+def stream_task(uuid: str) -> Response:
+    """Stream the progress of task `uuid` as server-sent events.
+
+    Every event carries a JSON object with the task's `state` and the `partial`
+    results published since the previous event (to be merged by the client,
+    `edges` are new edges to append to the earlier ones); the last event has state `stopped` and carries the final `result` (and the
+    task's `metrics`) instead, or state `error` and the `error` message of a
+    failed task.
+    The stream ends after the last event, after a `cancelled` event, or
+    immediately for unknown tasks (which have an empty state). Clients closing
+    the stream early cancel the task.
+    """
+    def events() -> Iterator[str]:
+        version, sent, state = None, {}, ""
+        offsets = dict((name, 0) for name in APPENDED)
+        try:
+            while True:
+                current, state, partial = engine.watch(
+                    uuid, version, STREAM_KEEPALIVE, offsets)
+                if current == version:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                version = current
+                if state == "stopped":
+                    metrics = engine.instrumentation(uuid)
+                    result = engine.obtain_result(uuid)
+                    yield (f"data: {json.dumps({'state': state, 'metrics': metrics, 'result': result})}"
+                           "\n\n")
+                    return
+                if state == "error":
+                    metrics = engine.instrumentation(uuid)
+                    error = partial.get("error", "")
+                    engine.obtain_result(uuid)
+                    yield f"data: {json.dumps({'state': state, 'metrics': metrics, 'error': error})}\n\n"
+                    return
+
+                # only send the values that changed (by value, as the engine
+                # may live in another process), and the appended parts
+                changed = dict((key, value) for key, value in partial.items()
+                               if key not in APPENDED and (key not in sent or sent[key] != value))
+                sent.update(changed)
+                for name in APPENDED:
+                    if partial.get(name):
+                        changed[name] = partial[name]
+                        offsets[name] += len(partial[name])
+
+                yield f"data: {json.dumps({'state': state, 'partial': changed})}\n\n"
+                if state in ("", "cancelled"):
+                    return
+        finally:
+            if state not in ("", "stopped", "cancelled", "error"):  # client went away
+                engine.cancel(uuid)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
+def poll_task(uuid: str) -> Response:
+    """Returns the `state` and `metrics` of task `uuid`, with its `result` once
+    stopped, or its `error` message once failed."""
+    metrics = engine.instrumentation(uuid)
+    if (state := engine.status(uuid)) == "stopped":
+        return jsonify({"state": state, "metrics": metrics, "result": engine.obtain_result(uuid)})
+    if state == "error":
+        _, _, partial = engine.watch(uuid, None, 0)
+        engine.obtain_result(uuid)
+        return jsonify({"state": state, "metrics": metrics, "error": partial.get("error", "")})
+
+    return jsonify({"state": state, "metrics": metrics})
+
+
+OPTIONS = {"candidates": int, "width": int, "interleave": bool}  # optional, by type
+
+
+class InvalidQuery(ValueError):
+    """Raised for malformed task queries, answered with status 400."""
+
+
+def parse_options(query: dict, names: tuple[str, ...]) -> dict:
+    """Returns the optional `names` settings present in `query`, raises
+    `InvalidQuery` for values of the wrong type or negative numbers."""
+    options = dict((key, query[key]) for key in names if key in query)
+    for key, value in options.items():
+        # `bool` is a subclass of `int`, so it is never a valid number
+        if type(value) is not OPTIONS[key] or (OPTIONS[key] is int and value < 0):
+            raise InvalidQuery(f"invalid `{key}`: {value!r}")
+
+    return options
+
+
+@app.errorhandler(InvalidQuery)
+def invalid_query(error: InvalidQuery) -> tuple[Response, int]:
+    return jsonify({"error": str(error)}), 400
+
 
 @app.route("/")
 def index() -> Response:
@@ -27,22 +132,34 @@ def index() -> Response:
 
 @app.route("/api/story")
 def query_story_list() -> Response:
-    """Returns a sorted list, by title, of `(uuid, title)` pairs.
+    """Returns one page of the sorted list, by title, of `(uuid, title)` pairs.
 
-    This view returns a list of `(uuid, title)` pairs each representing a story
-    in the ROCStories Dataset that is accessible by the backend. The list is
-    potentially huge, and it is the caller's responsibility to break it up, if
-    necessary, due to performance concerns.
+    This view returns a page of `(uuid, title)` pairs each representing a story
+    in the ROCStories Dataset that is accessible by the backend. Pages are
+    selected with the `offset` and `limit` query parameters (`limit` is capped
+    at `STORY_PAGE_LIMIT`), and the list can be narrowed down to titles with a
+    case insensitive `prefix`. Responses carry an ETag, which only changes when
+    the dataset does.
 
     Returns
     -------
     Response
-        JSON response with field `stories` which is a sorted list, by title, of
-        `(uuid, title)` pairs.
+        JSON response with the following fields:
+        * `total`: `int`                      - The number of matching stories.
+        * `stories`: `list[tuple[str, str]]`  - The page of `(uuid, title)`
+                                                pairs, sorted by title.
     """
-    stories = ((uuid, title) for uuid, (title, *_) in STORIES.items())
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 1000, type=int), 0), STORY_PAGE_LIMIT)
+    prefix = request.args.get("prefix", "")
+
+    response = jsonify(dict(zip(("total", "stories"),
+                                STORIES.titles(offset, limit, prefix))))
+    page = hashlib.sha256(f"{offset}:{limit}:{prefix}".encode()).hexdigest()
+    response.set_etag(f"{STORIES.etag}-{page[:16]}")
+    response.cache_control.no_cache = True  # always revalidate with the ETag
 
-    return jsonify({"stories": sorted(stories, key=lambda x: x[1])})
+    return response.make_conditional(request)
 
 
 @app.route("/api/story/<uuid>")
@@ -66,8 +183,8 @@ def query_story_text(uuid: str) -> Response:
         * `title`: `Optional[str]        - The title of the story, if found.
         * `lines`: `Optional[list[str]]` - The lines of the story, if found.
     """
-    title, *lines = STORIES.get(uuid, (None, None))
-    lines = lines if len(lines) == 5 else None  # turn [None] to None
+    title, lines = STORIES.story(uuid) or (None, None)
+    lines = lines if lines is not None and len(lines) == 5 else None
 
     return jsonify({"uuid": uuid, "title": title, "lines": lines})
 
@@ -83,17 +200,24 @@ def setup_step_task() -> Response:
     question = query["question"]
     total = query["number"]
 
-    uuid = reasoner.submit_step(usage, order, aspect, context, question, total)
+    uuid = engine.submit_step(usage, order, aspect, context, question, total)
 
     return jsonify({"uuid": uuid})
 
 
 @app.route("/api/step/<uuid>")
 def query_step_task(uuid: str) -> Response:
-    if (state := reasoner.state.get(uuid, "")) != "stopped":
-        return jsonify({"state": state})
+    return poll_task(uuid)
+
+
+@app.route("/api/step/<uuid>/stream")
+def stream_step_task(uuid: str) -> Response:
+    return stream_task(uuid)
 
-    return jsonify({"state": state, "result": reasoner.obtain_result(uuid)})
+
+@app.route("/api/step/<uuid>", methods=["DELETE"])
+def cancel_step_task(uuid: str) -> Response:
+    return jsonify({"cancelled": engine.cancel(uuid)})
 
 
 @app.route("/api/path", methods=["POST"])
@@ -106,18 +230,27 @@ def setup_path_task() -> Response:
     length = query["length"]
     branch = query["branch"]
     total = query["total"]
+    options = parse_options(query, ("candidates", "width", "interleave"))
 
-    uuid = reasoner.submit_path(source, target, context, length, branch, total)
+    uuid = engine.submit_path(
+        source, target, context, length, branch, total, **options)
 
     return jsonify({"uuid": uuid})
 
 
 @app.route("/api/path/<uuid>")
 def query_path_task(uuid: str) -> Response:
-    if (state := reasoner.state.get(uuid, "")) != "stopped":
-        return jsonify({"state": state})
+    return poll_task(uuid)
+
+
+@app.route("/api/path/<uuid>/stream")
+def stream_path_task(uuid: str) -> Response:
+    return stream_task(uuid)
 
-    return jsonify({"state": state, "result": reasoner.obtain_result(uuid)})
+
+@app.route("/api/path/<uuid>", methods=["DELETE"])
+def cancel_path_task(uuid: str) -> Response:
+    return jsonify({"cancelled": engine.cancel(uuid)})
 
 
 @app.route("/api/graph", methods=["POST"])
@@ -129,15 +262,82 @@ def setup_graph_task() -> Response:
     length = query["length"]
     branch = query["branch"]
     total = query["total"]
+    options = parse_options(query, ("candidates", "width"))
 
-    uuid = reasoner.submit_graph(target, context, length, branch, total)
+    uuid = engine.submit_graph(
+        target, context, length, branch, total, **options)
 
     return jsonify({"uuid": uuid})
 
 
 @app.route("/api/graph/<uuid>")
 def query_graph_task(uuid: str) -> Response:
-    if (state := reasoner.state.get(uuid, "")) != "stopped":
-        return jsonify({"state": state})
+    return poll_task(uuid)
+
+
+@app.route("/api/graph/<uuid>/stream")
+def stream_graph_task(uuid: str) -> Response:
+    return stream_task(uuid)
+
+
+@app.route("/api/graph/<uuid>", methods=["DELETE"])
+def cancel_graph_task(uuid: str) -> Response:
+    return jsonify({"cancelled": engine.cancel(uuid)})
+
+
+@app.route("/api/cache")
+def query_cache_stats() -> Response:
+    """Returns the hit and miss counters of the generation cache.
 
-    return jsonify({"state": state, "result": reasoner.obtain_result(uuid)})
+    Returns
+    -------
+    Response
+        JSON response with the `memory_hits`, `disk_hits`, `misses`, and
+        `memory_size` counters of the generation cache, and the `hits`,
+        `misses`, `reused_layers`, and `size` counters of the graph store
+        under `graphs`, and the `hits`, `misses`, `hit_tokens`, `miss_tokens`,
+        `entries`, and `tokens` counters of the encoder cache under `encoder`.
+    """
+    return jsonify(engine.cache_stats())
+
+
+@app.route("/api/scheduler")
+def query_scheduler_stats() -> Response:
+    """Returns the queue depth and wait time statistics of the reasoner.
+
+    Returns
+    -------
+    Response
+        JSON response with the number of `workers`, the number of `busy`
+        workers, per-lane `depth`, `started`, `mean_wait`, and `max_wait`
+        statistics (wait times in seconds) under `lanes`, and the `batches`,
+        `prompts`, `requests`, and `mean_size` counters of the model batcher
+        under `batching`. The number of known `jobs`, `retained` results, and
+        `evicted` jobs describe the job lifecycle.
+    """
+    return jsonify(engine.stats())
+
+
+@app.route("/api/metrics")
+def query_metrics() -> Response:
+    """Returns the instrumentation aggregated over every job.
+
+    Returns
+    -------
+    Response
+        JSON response with the following fields:
+        * `counters`: `dict[str, float]` - Prompts, cache hits, model batches,
+                                           sequences, prompt, padding, and
+                                           generated tokens, inferences and
+                                           rejected (ill-formed) and duplicate
+                                           (merged) inferences, entailment
+                                           pairs, embedded texts, and the ratios
+                                           derived from them.
+        * `stages`: `dict[str, float]`   - Wall time, in seconds, spent in every
+                                           job stage (`waiting`, `f1`, `c`...).
+        * `memory`: `dict[str, int]`     - Highest process and device memory
+                                           use sampled at stage changes, and
+                                           their peaks over the lifetime of the
+                                           process.
+    """
+    return jsonify(engine.metrics())
@@ -0,0 +1,80 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+from threading import Lock
+from typing import Optional
+
+from graph import ReasoningGraph
+
+
+class GraphStore:
+    """Keyed SQLite store of (partially) searched reasoning graph sides.
+
+    A side is the part of a reasoning graph searched from one set of root
+    sentences in one direction: the forward side from the story sentences, or
+    the backward side from the target. It only depends on the roots, the story
+    context, the model, and the search settings (see `key`), so jobs sharing
+    those reuse each other's layers. Sides are saved after every layer, a job
+    interrupted midway resumes from its last finished layer.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.access: Lock = Lock()
+
+        self.disk: Optional[sqlite3.Connection] = None
+        if path:
+            self.disk = sqlite3.connect(path, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS side (key TEXT PRIMARY KEY, "
+                              "depth INTEGER NOT NULL, layers TEXT NOT NULL, graph BLOB NOT NULL)")
+            self.disk.commit()
+
+        self.counters: dict[str, int] = {"hits": 0, "misses": 0, "reused_layers": 0}
+
+    @staticmethod
+    def key(direction: str, roots: list[str], context: list[str], *settings) -> str:
+        return hashlib.sha256(
+            json.dumps([direction, roots, context, *settings]).encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[tuple[ReasoningGraph, list[list[int]]]]:
+        """Returns the stored side graph and the node ids of its layers."""
+        if self.disk is None:
+            return None
+
+        with self.access:
+            row = self.disk.execute(
+                "SELECT layers, graph FROM side WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+
+            layers = json.loads(row[0])
+            self.counters["hits"] += 1
+            self.counters["reused_layers"] += len(layers)
+
+        return ReasoningGraph.from_bytes(row[1]), layers
+
+    def save(self, key: str, graph: ReasoningGraph, layers: list[list[int]]):
+        if self.disk is None:
+            return
+
+        data = graph.to_bytes()
+        with self.access:
+            # never replace a deeper search with a shallower one
+            self.disk.execute("INSERT INTO side VALUES (?, ?, ?, ?) ON CONFLICT (key) "
+                              "DO UPDATE SET depth = excluded.depth, layers = excluded.layers, "
+                              "graph = excluded.graph WHERE excluded.depth > depth",
+                              (key, len(layers), json.dumps(layers), data))
+            self.disk.commit()
+
+    def stats(self) -> dict[str, int]:
+        with self.access:
+            size = 0 if self.disk is None else self.disk.execute(
+                "SELECT COUNT(*) FROM side").fetchone()[0]
+            return {**self.counters, "size": size}
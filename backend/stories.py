@@ -0,0 +1,139 @@
+# Copyright (c) 2021 Hecong Wang
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from threading import Lock
+from typing import Iterator, Optional
+
+
+def read_stories(path: str) -> Iterator[tuple[str, str, list[str]]]:
+    """Yield the `(uuid, title, lines)` of every story in the dataset CSV."""
+    with open(path, "r") as file:
+        reader = csv.reader(file)
+        assert len(next(reader)) == 7
+        for uuid, title, *lines in reader:
+            yield uuid, title, lines
+
+
+class StoryStore:
+    """The ROCStories Dataset, indexed once into a SQLite database.
+
+    Stories are stored by their rank in the title order, so pages of the sorted
+    title list are plain range scans. Titles are also indexed case insensitively
+    for prefix searches. The index is rebuilt only when the CSV file changes
+    (by size or modification time), so startup does not parse the CSV. Indexes
+    are built aside and moved into place whole, so processes starting together
+    (such as HTTP workers) never read a partially built index.
+    """
+
+    def __init__(self, source: str, path: str):
+        self.access: Lock = Lock()
+
+        stat = os.stat(source)
+        signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+
+        if self.signature(path) != signature:
+            self.build(source, path, signature)
+
+        # the index file is replaced, never modified, so its count stays valid
+        self.database: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+
+        self.etag: str = hashlib.sha256(signature.encode()).hexdigest()[:16]
+        self.total: int = self.database.execute(
+            "SELECT COUNT(*) FROM story").fetchone()[0]
+
+    @staticmethod
+    def signature(path: str) -> Optional[str]:
+        """Returns the CSV signature of the index at `path`, if any."""
+        if not os.path.exists(path):
+            return None
+
+        with closing(sqlite3.connect(path)) as database:
+            try:
+                row = database.execute(
+                    "SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            except sqlite3.DatabaseError:  # not an index (yet)
+                return None
+
+        return row and row[0]
+
+    @staticmethod
+    def build(source: str, path: str, signature: str):
+        """Index `source` into a temporary file, then move it to `path`."""
+        stories = sorted(((uuid, [title, *lines]) for uuid, title, lines in read_stories(source)),
+                         key=lambda x: x[1][0])
+
+        directory, name = os.path.split(os.path.abspath(path))
+        handle, temporary = tempfile.mkstemp(prefix=f"{name}-", suffix=".sqlite3", dir=directory)
+        os.close(handle)
+
+        try:
+            with closing(sqlite3.connect(temporary)) as database, database:
+                database.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                database.execute("CREATE TABLE story (rank INTEGER PRIMARY KEY, "
+                                 "uuid TEXT NOT NULL UNIQUE, title TEXT NOT NULL, "
+                                 "folded TEXT NOT NULL, lines TEXT NOT NULL)")
+                database.executemany(
+                    "INSERT INTO story VALUES (?, ?, ?, ?, ?)",
+                    ((rank, uuid, title, title.casefold(), json.dumps(lines))
+                     for rank, (uuid, (title, *lines)) in enumerate(stories)))
+                database.execute("CREATE INDEX story_folded ON story (folded, rank)")
+                database.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+
+            os.replace(temporary, path)  # atomic, readers see the old or new index
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def titles(self, offset: int, limit: int, prefix: str = "") -> tuple[int, list[tuple[str, str]]]:
+        """Returns the number of matching stories and one page of them.
+
+        Parameters
+        ----------
+        offset : int
+            The number of matching stories (in title order) to skip.
+        limit : int
+            The maximum number of stories in the page.
+        prefix : str
+            The case insensitive title prefix stories must match.
+
+        Returns
+        -------
+        tuple[int, list[tuple[str, str]]]
+            The total number of matching stories, and the page as a list of
+            `(uuid, title)` pairs sorted by title.
+        """
+        with self.access:
+            if not prefix:
+                stories = self.database.execute(
+                    "SELECT uuid, title FROM story WHERE rank >= ? ORDER BY rank LIMIT ?",
+                    (offset, limit)).fetchall()
+                return self.total, stories
+
+            lower = prefix.casefold()
+            upper = lower[:-1] + chr(ord(lower[-1]) + 1)
+
+            total = self.database.execute(
+                "SELECT COUNT(*) FROM story WHERE folded >= ? AND folded < ?",
+                (lower, upper)).fetchone()[0]
+            stories = self.database.execute(
+                "SELECT uuid, title FROM story WHERE folded >= ? AND folded < ? "
+                "ORDER BY rank LIMIT ? OFFSET ?", (lower, upper, limit, offset)).fetchall()
+            return total, stories
+
+    def story(self, uuid: str) -> Optional[tuple[str, list[str]]]:
+        """Returns the `(title, lines)` of story `uuid`, if found."""
+        with self.access:
+            row = self.database.execute(
+                "SELECT title, lines FROM story WHERE uuid = ?", (uuid,)).fetchone()
+
+        return row and (row[0], json.loads(row[1]))
@@ -4,31 +4,63 @@
 # https://opensource.org/licenses/MIT
 from __future__ import annotations
 
+import logging
+import os
 import re
-from itertools import chain, product, repeat, starmap
-from queue import Queue
-from threading import Lock, Thread
+import time
+from collections import OrderedDict
+from itertools import chain, count, product, repeat, starmap
+from queue import PriorityQueue
+from threading import Condition, Thread
+from typing import Callable, Iterator, Optional
 from uuid import uuid4
 
-import networkx as nx
 import numpy as np
 
-from reason import generate, prompt
-
-ASPECTS = ["causal", "emotional", "spatial", "possession", "miscellaneous"]
+from batcher import Batcher, Cancelled, owning
+from dedup import MinHashIndex
+from graph import ASPECTS, BACKWARD, ENTAILMENT, FORWARD, ReasoningGraph
+from metrics import METRICS, Metrics, memory, record, recording
+from reason import DEVICE, MAXIMUM_BATCH_SIZE, MODELS, prompt
+from store import GraphStore
+
+CONNECT_CHUNK = 4 * MAXIMUM_BATCH_SIZE  # entailment prompts per reported chunk
+CANDIDATES = int(os.environ.get("HAICOR_CANDIDATES", 16))  # 0 means exact
+WIDTH = int(os.environ.get("HAICOR_WIDTH", 0))  # 0 means exhaustive search
+FUZZY = float(os.environ.get("HAICOR_FUZZY", 0))  # 0 means exact (normalized) merging
+INTERLEAVE = bool(int(os.environ.get("HAICOR_INTERLEAVE", 0)))  # early-terminating paths
 PATTERN = re.compile(r"^\s*(.+)\s*>\s*(.+)\s*>\s*(.+)\s*$")
 
 
 # ============================= REASONING UTILITY ==============================
-def search_layer(graph: nx.DiGraph, direction: str, froniter: list[str], context: list[str], branch: int) -> list[str]:
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split()).strip(" .,;:!?")
+
+
+def search_layer(graph: ReasoningGraph, direction: str, froniter: list[int], branch: int, width: int = 0, fuzzy: float = FUZZY, check: Optional[Callable[[], None]] = None) -> list[int]:
+    """Expand `froniter` by one layer of inferences in `direction`.
+
+    Inferences of the layer with the same normalized text (see `normalize`)
+    share one node, keeping the largest cumulative path probability and the
+    most likely edge from each neighbour. With a positive `fuzzy` threshold,
+    inferences whose normalized texts have a trigram Jaccard similarity of at
+    least `fuzzy` (see `MinHashIndex`) are merged as well. With a positive
+    `width` the layer is pruned to the `width` nodes with the largest
+    cumulative path probability. `check` (if any) is called before the layer
+    is generated, to stop a cancelled job; the prompts of the layer are
+    generated in one request, so that they are packed by length together (a
+    request still pending when its job is cancelled is dropped by the batcher).
+    """
     def get_prompt(node, aspect):
-        usage = "general" if node["kind"] == "source" else "premise"
-        return prompt(usage, direction, aspect, context, node["text"])
+        usage = "general" if graph.kind(node) == "source" else "premise"
+        return prompt(usage, direction, aspect, graph.context, graph.text(node))
+
+    if check is not None:
+        check()
 
     # generate all the inferences (better performance)
-    nodes = [graph.nodes[id] for id in froniter]
-    prompts = starmap(get_prompt, product(nodes, ASPECTS))
-    results = generate(list(prompts), branch)
+    prompts = starmap(get_prompt, product(froniter, ASPECTS))
+    results = batcher.generate(list(prompts), branch)
 
     # setup generators for other information (completeness)
     aspects = list(chain.from_iterable(repeat(i, branch) for i in ASPECTS))
@@ -36,217 +68,589 @@ def search_layer(graph: nx.DiGraph, direction: str, froniter: list[str], context
 
     sources = chain.from_iterable(repeat(i, 5 * branch) for i in froniter)
 
-    froniter = []
+    froniter, merged = [], {}
+    similar = MinHashIndex(fuzzy) if fuzzy > 0 else None
+    record(inferences=len(results))
     for result, aspect, source in zip(results, aspects, sources):
-        prompts, result, score = result
+        _, result, score = result
         if (match := re.fullmatch(PATTERN, result)) is None:
             # generated output is ill-formed
+            record(rejected=1)
             continue
 
-        uuid = str(uuid4())
-        froniter.append(uuid)
-
         lhs, _, rhs = match.groups()
+        text = rhs if direction == "forward" else lhs
+        probability = graph.probabilities[source] * score
+
+        key = normalize(text)
+        if (node := merged.get(key)) is None and similar is not None:
+            node = similar.lookup(key)
+
+        if node is not None:
+            graph.probabilities[node] = max(graph.probabilities[node], probability)
+            record(duplicates=1)
+        else:
+            node = graph.add_node("middle", text, probability)
+            froniter.append(node)
+            if similar is not None:
+                similar.add(key, node)
+
+        merged[key] = node
+
+        # merged nodes keep the most likely edge from each neighbour
         if direction == "forward":
-            graph.add_node(uuid, kind="middle", text=rhs)
-            graph.add_edge(source, uuid, aspect=aspect,
-                           prompt=prompts, result=result, score=score)
+            edge, order = (source, node), FORWARD
         else:
-            graph.add_node(uuid, kind="middle", text=lhs)
-            graph.add_edge(uuid, source, aspect=aspect,
-                           prompt=prompts, result=result, score=score)
+            edge, order = (node, source), BACKWARD
+
+        if (known := graph.edge(*edge)) is None or graph.scores[known] < score:
+            graph.add_edge(*edge, order, aspect, result, score)
+
+    if width > 0 and len(froniter) > width:
+        froniter.sort(key=lambda node: graph.probabilities[node], reverse=True)
+        graph.remove_nodes(froniter[width:])
+        froniter = froniter[:width]
 
     return froniter
 
 
-def connect_nodes(graph: nx.DiGraph, premises: list[str], hypotheses: list[str]):
+def select_pairs(premises: list[str], hypotheses: list[str], candidates: int) -> list[tuple[int, int]]:
+    """Select the `(premise, hypothesis)` index pairs worth an entailment query.
+
+    Every premise is paired with its `candidates` most similar hypotheses and
+    every hypothesis with its `candidates` most similar premises, by cosine
+    similarity of their encoder embeddings (computed on the batcher's model
+    replicas). A non-positive `candidates` selects every pair (the exact cross
+    product).
+    """
+    if (candidates <= 0 or not premises or not hypotheses
+            or (len(premises) <= candidates and len(hypotheses) <= candidates)):
+        return list(product(range(len(premises)), range(len(hypotheses))))
+
+    embeddings = batcher.embed(premises + hypotheses)
+    similarity = embeddings[:len(premises)] @ embeddings[len(premises):].T
+
+    pairs = set()
+    if len(hypotheses) > candidates:  # best hypotheses of each premise
+        best = np.argpartition(-similarity, candidates - 1, axis=1)[:, :candidates].tolist()
+        pairs.update((i, j) for i, row in enumerate(best) for j in row)
+    else:
+        pairs.update(product(range(len(premises)), range(len(hypotheses))))
+
+    if len(premises) > candidates:  # best premises of each hypothesis
+        best = np.argpartition(-similarity, candidates - 1, axis=0)[:candidates].tolist()
+        pairs.update((i, j) for row in best for j, i in enumerate(row))
+    else:
+        pairs.update(product(range(len(premises)), range(len(hypotheses))))
+
+    return sorted(pairs)
+
+
+def connect_nodes(graph: ReasoningGraph, premises: list[int], hypotheses: list[int], candidates: int, report: Optional[Callable[[list[int]], None]] = None):
     def get_prompt(premise, hypothesis):
         return f"mnli hypothesis: {hypothesis} premise: {premise}"
 
-    # generate all the connections (better performance)
-    premise_texts = [graph.nodes[uuid]["text"] for uuid in premises]
-    hypothesis_texts = [graph.nodes[uuid]["text"] for uuid in hypotheses]
-    prompts = starmap(get_prompt, product(premise_texts, hypothesis_texts))
-    results = generate(list(prompts), 1)
+    # retrieve the likely connections (all of them when `candidates` <= 0)
+    premise_texts = [graph.text(node) for node in premises]
+    hypothesis_texts = [graph.text(node) for node in hypotheses]
+    pairs = [(premises[i], hypotheses[j]) for i, j in
+             select_pairs(premise_texts, hypothesis_texts, candidates)]
+    record(pairs=len(pairs), exhaustive_pairs=len(premises) * len(hypotheses))
+
+    # generate the connections chunk by chunk (`report` sees each new chunk)
+    for start in range(0, len(pairs), CONNECT_CHUNK):
+        chunk = pairs[start:start + CONNECT_CHUNK]
+        prompts = [get_prompt(graph.text(premise), graph.text(hypothesis))
+                   for premise, hypothesis in chunk]
+        results = batcher.generate(prompts, 1)
+
+        edges = []
+        for result, (source, target) in zip(results, chunk):
+            _, result, score = result
+            if result != "entailment":
+                # no logical connection
+                continue
+
+            edges.append(graph.add_edge(
+                source, target, ENTAILMENT, "entailment", result, score))
+
+        record(entailments=len(edges))
+
+        if report is not None:
+            report(edges)
 
-    for result, (source, target) in zip(results, product(premises, hypotheses)):
-        prompt, result, score = result
-        if result != "entailment":
-            # no logical connection
-            continue
 
-        graph.add_edge(source, target, aspect="entailment",
-                       prompt=prompt, result=result, score=score)
 # ============================= REASONING UTILITY ==============================
 
 
-class Reasoner(Thread):
-    def __init__(self):
-        super().__init__()
+WORKERS = os.environ.get("HAICOR_WORKERS", DEVICE).split(",")  # model replicas
+JOBS = int(os.environ.get("HAICOR_JOBS", 4))  # concurrently running jobs
+LANES = {"step": 0, "path": 1, "graph": 2}  # lower lanes are served first
+
+# searched graph sides shared across jobs (an empty path disables the store)
+STORE_PATH = os.environ.get("HAICOR_GRAPH_STORE", "./graphs.sqlite3")
+STORE = GraphStore(STORE_PATH)
+
+# finished jobs are forgotten after `TTL` seconds, at most `RETAINED` are kept
+TTL = float(os.environ.get("HAICOR_TTL", 3600))
+RETAINED = int(os.environ.get("HAICOR_RETAINED", 256))
+FINISHED = ("stopped", "cancelled", "error")
+APPENDED = ("edges",)  # partial results published in parts, see `Reasoner.progress`
 
-        self.access: Lock = Lock()
 
-        self.tasks: Queue = Queue()
+class Reasoner:
+    def __init__(self, jobs: int, ttl: float = TTL, retained: int = RETAINED):
+        self.access: Condition = Condition()
+
+        self.tasks: PriorityQueue = PriorityQueue()
         self.state: dict[str, str] = {}
         self.cache: dict[str, list] = {}
 
+        # job lifecycle, finished jobs in the order they finished
+        self.ttl: float = ttl
+        self.retained: int = retained
+        self.cancelled: set[str] = set()
+        self.finished: OrderedDict[str, float] = OrderedDict()
+
+        # partial results published while a job is running, see `watch`
+        self.partial: dict[str, dict] = {}
+        self.version: dict[str, int] = {}
+
+        # instrumentation of every job, and the stage each job is in since when
+        self.metrics: dict[str, Metrics] = {}
+        self.entered: dict[str, tuple[str, float]] = {}
+
+        # worker threads drive jobs, the model replicas are owned by `batcher`
+        self.order: Iterator[int] = count()
+        self.workers: list[Thread] = [
+            Thread(target=self.run, name=f"reasoner-{index}") for index in range(jobs)]
+
+        # scheduler statistics, per lane
+        self.busy: int = 0
+        self.depth: dict[str, int] = dict.fromkeys(LANES, 0)
+        self.started: dict[str, int] = dict.fromkeys(LANES, 0)
+        self.waited: dict[str, float] = dict.fromkeys(LANES, 0.0)
+        self.longest: dict[str, float] = dict.fromkeys(LANES, 0.0)
+        self.evicted: int = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for _ in self.workers:  # termination tasks, served after pending tasks
+            self.tasks.put((len(LANES), next(self.order), 0.0, None, None, None))
+
+        for worker in self.workers:
+            worker.join()
+
     def run(self):
-        while (task := self.tasks.get()):
-            if task == None:  # termination task
-                break
+        while (task := self.tasks.get())[-1] is not None:
+            _, _, submitted, uuid, task, args = task
+            with self.access:
+                self.depth[task] -= 1
+                if uuid in self.cancelled:  # cancelled while waiting
+                    self.cancelled.discard(uuid)
+                    continue
 
-            uuid, task, args = task
-            if task == "step":
-                result = self.reason_step(*args)
-            elif task == "path":
-                result = self.reason_path(*args)
-            elif task == "graph":
-                result = self.reason_graph(*args)
+                waited = time.monotonic() - submitted
+                self.enter(uuid, "running")
+
+                self.busy += 1
+                self.started[task] += 1
+                self.waited[task] += waited
+                self.longest[task] = max(self.longest[task], waited)
+
+            state, result, error = "stopped", None, None
+            try:
+                with recording(METRICS, self.metrics[uuid]), owning(uuid):
+                    if task == "step":
+                        result = self.reason_step(*args)
+                    elif task == "path":
+                        result = self.reason_path(*args)
+                    elif task == "graph":
+                        result = self.reason_graph(*args)
+            except Cancelled:
+                pass
+            except Exception as exception:  # the job fails, its worker goes on
+                logging.exception("%s job %s failed", task, uuid)
+                state, error = "error", f"{type(exception).__name__}: {exception}"
 
             with self.access:
-                self.cache[uuid] = result
-                self.state[uuid] = "stopped"
+                self.busy -= 1
+                if uuid in self.cancelled:  # already finished by `cancel`
+                    self.cancelled.discard(uuid)
+                    continue
+
+                if error is not None:  # published like partial results
+                    self.partial[uuid] = {"error": error}
+
+                self.finish(uuid, state, result)
+
+    def finish(self, uuid: str, state: str, result: Optional[list]):
+        # caller must hold self.access
+        if result is not None:
+            self.cache[uuid] = result
+
+        self.enter(uuid, state)
+        self.state[uuid] = state
+        self.version[uuid] += 1
+        self.finished[uuid] = time.monotonic()
+        self.access.notify_all()
+
+        self.evict()
+
+    def evict(self):
+        """Forget finished jobs older than `ttl` or beyond the `retained` most
+        recent ones (caller must hold self.access)."""
+        deadline = time.monotonic() - self.ttl
+        while self.finished and (len(self.finished) > self.retained
+                                 or next(iter(self.finished.values())) < deadline):
+            uuid, _ = self.finished.popitem(last=False)
+            for table in (self.state, self.cache, self.partial, self.version,
+                          self.metrics, self.entered):
+                table.pop(uuid, None)
+
+            self.evicted += 1
+
+    def cancel(self, uuid: str) -> bool:
+        """Cancel job `uuid`, returns whether it was waiting or running.
+
+        Waiting jobs never start; running jobs stop at their next `progress`
+        or `check` call, which happen between layers and between chunks of
+        model prompts, and their requests still pending in `batcher` are
+        dropped.
+        """
+        with self.access:
+            if self.state.get(uuid, "") in ("", *FINISHED):
+                return False
+
+            self.cancelled.add(uuid)
+            self.partial[uuid] = {}
+            self.finish(uuid, "cancelled", None)
+
+        batcher.cancel(uuid)
+        return True
+
+    def enqueue(self, uuid: str, task: str, args: tuple):
+        # caller must hold self.access
+        self.evict()
+
+        self.state[uuid] = "waiting"
+        self.partial[uuid] = {}
+        self.version[uuid] = 0
+        self.metrics[uuid] = Metrics()
+        self.entered[uuid] = ("waiting", time.monotonic())
+        self.depth[task] += 1
+        self.tasks.put((LANES[task], next(self.order), time.monotonic(), uuid, task, args))
 
     def submit_step(self, usage: str, order: str, aspect: str, context: list[str], question: str, total: int) -> str:
         with self.access:
             uuid = str(uuid4())
-            self.state[uuid] = "waiting"
-            self.tasks.put(
-                (uuid, "step", (usage, order, aspect, context, question, total)))
+            self.enqueue(
+                uuid, "step", (usage, order, aspect, context, question, total))
 
         return uuid
 
-    def submit_path(self, source: str, target: str, context: list[str], length: int, branch: int, total: int) -> str:
+    def submit_path(self, source: str, target: str, context: list[str], length: int, branch: int, total: int, candidates: int = CANDIDATES, width: int = WIDTH, interleave: bool = INTERLEAVE) -> str:
         with self.access:
             uuid = str(uuid4())
-            self.state[uuid] = "waiting"
-            self.tasks.put(
-                (uuid, "path", (uuid, source, target, context, length, branch, total)))
+            self.enqueue(
+                uuid, "path", (uuid, source, target, context, length, branch, total, candidates, width, interleave))
 
         return uuid
 
-    def submit_graph(self, target: str, context: list[str], length: int, branch: int, total: int) -> str:
+    def submit_graph(self, target: str, context: list[str], length: int, branch: int, total: int, candidates: int = CANDIDATES, width: int = WIDTH) -> str:
         with self.access:
             uuid = str(uuid4())
-            self.state[uuid] = "waiting"
-            self.tasks.put(
-                (uuid, "graph", (uuid, target, context, length, branch, total)))
+            self.enqueue(
+                uuid, "graph", (uuid, target, context, length, branch, total, candidates, width))
 
         return uuid
 
-    def reason_step(self, usage: str, order: str, aspect: str, context: list[str], question: str, total: int) -> list[tuple[float, str]]:
-        temp = prompt(usage, order, aspect, context, question)
-        return [(score, result) for _, result, score in generate(temp, total)]
+    def progress(self, uuid: str, state: str, **partial):
+        """Update the state of job `uuid` and publish its `partial` results.
 
-    def reason_path(self, uuid: str, source: str, target: str, context: list[str], length: int, branch: int, total: int) -> list[list[str]]:
-        # setup reasoning graph
-        reasoning = nx.DiGraph(source=source, target=target, context=context)
+        Published values replace earlier values under the same name, they must
+        not be mutated afterwards since `watch` hands them out as they are.
+        Values under `APPENDED` names are lists appended to the values
+        published before instead (see `watch`). Raises `Cancelled` once the job
+        has been cancelled.
+        """
+        with self.access:
+            if uuid in self.cancelled:
+                raise Cancelled(uuid)
+
+            self.enter(uuid, state)
+            self.state[uuid] = state
+            for name in APPENDED:
+                if name in partial:
+                    self.partial[uuid].setdefault(name, []).extend(partial.pop(name))
+            self.partial[uuid].update(partial)
+            self.version[uuid] += 1
+            self.access.notify_all()
+
+    def check(self, uuid: str):
+        """Raises `Cancelled` once job `uuid` has been cancelled."""
+        with self.access:
+            if uuid in self.cancelled:
+                raise Cancelled(uuid)
 
-        def get_path(path):
-            score, result = 1, [reasoning.nodes[path[0]]["text"]]
-            for source, target in zip(path, path[1:]):
-                score *= reasoning.edges[source, target]["score"]
+    def enter(self, uuid: str, stage: str):
+        """Time the stage job `uuid` is leaving, if entering another one, and
+        sample the memory use, in its metrics (caller must hold self.access)."""
+        if uuid not in self.entered or (previous := self.entered[uuid])[0] == stage:
+            return
 
-                result.append(reasoning.edges[source, target]["result"])
-                result.append(reasoning.nodes[target]["text"])
+        now, usage = time.monotonic(), memory()
+        for metrics in (self.metrics[uuid], METRICS):
+            metrics.time(previous[0], now - previous[1])
+            metrics.peak(**usage)
 
-            return score, result
+        self.entered[uuid] = (stage, now)
 
-        # forward and backward search
-        source_uuid = str(uuid4())
-        reasoning.add_node(source_uuid, kind="source", text=source)
+    def instrumentation(self, uuid: str) -> Optional[dict]:
+        """Returns the metrics snapshot of job `uuid`, if known."""
+        with self.access:
+            metrics = self.metrics.get(uuid)
 
-        forward_froniter = [source_uuid]
-        for step in range(length):
-            with self.access:
-                self.state[uuid] = f"f{step + 1}"
-            forward_froniter = search_layer(
-                reasoning, "forward", forward_froniter, context, branch)
+        return metrics and metrics.snapshot()
 
-        target_uuid = str(uuid4())
-        reasoning.add_node(target_uuid, kind="target", text=target)
+    def status(self, uuid: str) -> str:
+        """Returns the state of job `uuid`, empty for unknown jobs."""
+        with self.access:
+            return self.state.get(uuid, "")
 
-        backward_froniter = [target_uuid]
-        for step in range(length):
-            with self.access:
-                self.state[uuid] = f"b{step + 1}"
-            backward_froniter = search_layer(
-                reasoning, "backward", backward_froniter, context, branch)
+    def wait_any(self, uuids: list[str], timeout: float) -> list[str]:
+        """Wait for any of the jobs `uuids` to finish, or for `timeout` seconds.
 
-        # forward and backward search connection
+        Returns
+        -------
+        list[str]
+            The jobs of `uuids` that have finished (stopped, cancelled, or
+            failed).
+        """
         with self.access:
-            self.state[uuid] = "c"
-        connect_nodes(reasoning, forward_froniter, backward_froniter)
+            self.access.wait_for(
+                lambda: any(self.state.get(i) in FINISHED for i in uuids), timeout)
 
-        # find most likely (largest product) reasoning paths
+            return [i for i in uuids if self.state.get(i) in FINISHED]
+
+    def watch(self, uuid: str, version: Optional[int], timeout: float, offsets: Optional[dict[str, int]] = None) -> tuple[int, str, dict]:
+        """Wait for job `uuid` to move past `version`, or for `timeout` seconds.
+
+        Values under `APPENDED` names are returned from `offsets[name]` on, so
+        that watchers that keep count of what they already have only get (and
+        copy) the parts appended since.
+
+        Returns
+        -------
+        tuple[int, str, dict]
+            The current `(version, state, partial)` of the job, `version` is
+            `-1` and `state` is empty for unknown jobs.
+        """
+        offsets = offsets or {}
         with self.access:
-            self.state[uuid] = "s"
-        try:
-            paths = nx.all_shortest_paths(
-                reasoning, source_uuid, target_uuid, lambda u, v, e: -np.log(e["score"]))
-            return [get_path(path) for path, _ in zip(paths, range(total))]
-        except nx.NetworkXNoPath:
-            return []
-
-    def reason_graph(self, uuid: str, target: str, context: list[str], length: int, branch: int, total: int) -> list[list[str]]:
-        # setup reasoning graph
-        reasoning = nx.DiGraph(target=target, context=context)
+            self.access.wait_for(
+                lambda: self.version.get(uuid, -1) != version, timeout)
 
-        def get_path(path):
-            score, result = 1, [reasoning.nodes[path[0]]["text"]]
-            for source, target in zip(path, path[1:]):
-                score *= reasoning.edges[source, target]["score"]
+            partial = dict(self.partial.get(uuid, {}))
+            for name in APPENDED:
+                if name in partial:
+                    partial[name] = partial[name][offsets.get(name, 0):]
 
-                result.append(reasoning.edges[source, target]["result"])
-                result.append(reasoning.nodes[target]["text"])
+            return self.version.get(uuid, -1), self.state.get(uuid, ""), partial
 
-            return score, result
+    def stats(self) -> dict:
+        """Returns the queue depth and wait time statistics of every lane."""
+        with self.access:
+            lanes = {}
+            for lane, started in self.started.items():
+                lanes[lane] = {"depth": self.depth[lane],
+                               "started": started,
+                               "mean_wait": self.waited[lane] / (started or 1),
+                               "max_wait": self.longest[lane]}
 
-        # forward and backward search
-        source_uuids = [str(uuid4()) for _ in context]
-        reasoning.add_nodes_from(
-            [(uuid, {"kind": "source", "text": text}) for uuid, text in zip(source_uuids, context)])
+            return {"workers": len(self.workers), "busy": self.busy, "lanes": lanes,
+                    "jobs": len(self.state), "retained": len(self.cache),
+                    "evicted": self.evicted}
 
-        forward_froniter = source_uuids[:]
-        for step in range(length):
-            with self.access:
-                self.state[uuid] = f"f{step + 1}"
-            forward_froniter = search_layer(
-                reasoning, "forward", forward_froniter, context, branch)
+    def reason_step(self, usage: str, order: str, aspect: str, context: list[str], question: str, total: int) -> list[tuple[float, str]]:
+        temp = prompt(usage, order, aspect, context, question)
+        return [(score, result) for _, result, score in batcher.generate(temp, total)]
+
+    def search_side(self, uuid: str, direction: str, roots: list[tuple[str, str]], context: list[str], length: int, branch: int, width: int) -> tuple[ReasoningGraph, list[int], list[int]]:
+        """Search `length` layers in `direction` from the `(kind, text)` roots.
+
+        Layers already searched by an earlier (possibly interrupted) job with
+        the same roots, context, model, and settings are loaded from `STORE`
+        instead of generated again, and every newly searched layer is saved.
+
+        Returns
+        -------
+        tuple[ReasoningGraph, list[int], list[int]]
+            The side graph, its root node ids, and its last frontier.
+        """
+        model = MODELS["glucose"]
+        key = GraphStore.key(direction, roots, context, branch, width, FUZZY, model.identity,
+                             sorted(set(model.mode(device) for device in WORKERS)))
+
+        if (stored := STORE.load(key)) is not None:
+            side, layers = stored
+            if len(layers) > length:  # drop the layers deeper than needed
+                side.remove_nodes(list(chain.from_iterable(layers[length:])))
+                layers = layers[:length]
+        else:
+            side, layers = ReasoningGraph(context), []
+            for kind, text in roots:
+                side.add_node(kind, text)
 
-        target_uuid = str(uuid4())
-        reasoning.add_node(target_uuid, kind="target", text=target)
+        prefix, name = ("f", "forward") if direction == "forward" else ("b", "backward")
+        texts = [[side.text(i) for i in layer] for layer in layers]
+        if texts:
+            self.progress(uuid, f"{prefix}{len(texts)}", **{name: list(texts)})
 
-        backward_froniter = [target_uuid]
-        for step in range(length):
-            with self.access:
-                self.state[uuid] = f"b{step + 1}"
-            backward_froniter = search_layer(
-                reasoning, "backward", backward_froniter, context, branch)
+        froniter = layers[-1] if layers else list(range(len(roots)))
+        for step in range(len(layers), length):
+            self.progress(uuid, f"{prefix}{step + 1}")
+            froniter = search_layer(side, direction, froniter, branch, width,
+                                    check=lambda: self.check(uuid))
 
-        # forward and backward search connection
-        with self.access:
-            self.state[uuid] = "c"
-        connect_nodes(reasoning, forward_froniter, backward_froniter)
+            layers.append(froniter)
+            STORE.save(key, side, layers)
+
+            texts.append([side.text(i) for i in froniter])
+            self.progress(uuid, f"{prefix}{step + 1}", **{name: list(texts)})
+
+        return side, list(range(len(roots))), froniter
+
+    def reason_path(self, uuid: str, source: str, target: str, context: list[str], length: int, branch: int, total: int, candidates: int, width: int, interleave: bool = False) -> list[list[str]]:
+        if interleave:
+            return self.interleave_path(uuid, source, target, context, length, branch, total, candidates, width)
+
+        # forward and backward search (reusing stored layers)
+        forward, source_ids, forward_froniter = self.search_side(
+            uuid, "forward", [("source", source)], context, length, branch, width)
+        backward, target_ids, backward_froniter = self.search_side(
+            uuid, "backward", [("target", target)], context, length, branch, width)
+
+        # setup reasoning graph
+        reasoning = ReasoningGraph(context)
+        reasoning.merge(forward)
+        offset = reasoning.merge(backward)
+
+        target_id = target_ids[0] + offset
+        backward_froniter = [i + offset for i in backward_froniter]
+
+        # forward and backward search connection (reporting the best path yet)
+        self.progress(uuid, "c")
+        connect_nodes(reasoning, forward_froniter, backward_froniter, candidates,
+                      self.reporter(uuid, reasoning, source_ids, target_id))
 
         # find most likely (largest product) reasoning paths
-        with self.access:
-            self.state[uuid] = "s"
+        self.progress(uuid, "s")
+        paths = reasoning.path_index(source_ids).shortest_paths(target_id, total)
+        return [reasoning.describe(path) for path in paths]
+
+    def interleave_path(self, uuid: str, source: str, target: str, context: list[str], length: int, branch: int, total: int, candidates: int, width: int) -> list[list[str]]:
+        """Search from both ends at once, stopping as soon as deeper layers
+        cannot improve on the best `total` paths.
+
+        The side with the smaller frontier is searched next (up to `length`
+        layers per side), and every new layer is connected right away with
+        every layer of the other side searched so far, so paths may be shorter
+        than `2 * length + 1` edges. A path through unsearched layers passes a
+        frontier node, so it cannot score more than the largest cumulative
+        probability on the frontiers: once the `total`th best path found beats
+        that bound the search stops. Stored layers are not used in this mode.
+        """
+        reasoning = ReasoningGraph(context)
+        source_id = reasoning.add_node("source", source)
+        target_id = reasoning.add_node("target", target)
+        report = self.reporter(uuid, reasoning, [source_id], target_id)
+
+        sides = {"forward": [[source_id]], "backward": [[target_id]]}
+        texts = {"forward": [], "backward": []}
+
         paths = []
-        for source_uuid in source_uuids:
-            try:
-                path = nx.all_shortest_paths(
-                    reasoning, source_uuid, target_uuid, lambda u, v, e: -np.log(e["score"]))
-                paths.extend(get_path(p) for p, _ in zip(path, range(total)))
-            except nx.NetworkXNoPath:
-                return []
+        while expandable := [i for i, layers in sides.items() if len(layers) <= length and layers[-1]]:
+            direction = min(expandable, key=lambda i: len(sides[i][-1]))
+            other = "backward" if direction == "forward" else "forward"
+            layers = sides[direction]
+
+            self.progress(uuid, f"{direction[0]}{len(layers)}")
+            froniter = search_layer(reasoning, direction, layers[-1], branch, width,
+                                    check=lambda: self.check(uuid))
+
+            layers.append(froniter)
+            texts[direction].append([reasoning.text(i) for i in froniter])
+            self.progress(uuid, f"{direction[0]}{len(layers) - 1}",
+                          **{direction: list(texts[direction])})
+
+            # connect the new layer with the other side searched so far
+            self.progress(uuid, "c")
+            searched = list(chain.from_iterable(sides[other]))
+            if direction == "forward":
+                connect_nodes(reasoning, froniter, searched, candidates, report)
+            else:
+                connect_nodes(reasoning, searched, froniter, candidates, report)
+
+            paths = reasoning.path_index([source_id]).shortest_paths(target_id, total)
+            bound = max((reasoning.probabilities[i] for layers in sides.values()
+                         if len(layers) <= length for i in layers[-1]), default=0.0)
+            if len(paths) >= total and reasoning.describe(paths[-1])[0] >= bound:
+                record(early_stops=1)
+                break
+
+        self.progress(uuid, "s")
+        return [reasoning.describe(path) for path in paths]
+
+    def reason_graph(self, uuid: str, target: str, context: list[str], length: int, branch: int, total: int, candidates: int, width: int) -> list[list[str]]:
+        # forward and backward search (reusing stored layers)
+        forward, source_ids, forward_froniter = self.search_side(
+            uuid, "forward", [("source", text) for text in context], context, length, branch, width)
+        backward, target_ids, backward_froniter = self.search_side(
+            uuid, "backward", [("target", target)], context, length, branch, width)
+
+        # setup reasoning graph
+        reasoning = ReasoningGraph(context)
+        reasoning.merge(forward)
+        offset = reasoning.merge(backward)
+
+        target_id = target_ids[0] + offset
+        backward_froniter = [i + offset for i in backward_froniter]
+
+        # forward and backward search connection (reporting the best path yet)
+        self.progress(uuid, "c")
+        connect_nodes(reasoning, forward_froniter, backward_froniter, candidates,
+                      self.reporter(uuid, reasoning, source_ids, target_id))
+
+        # find most likely (largest product) reasoning paths
+        self.progress(uuid, "s")
+        paths = reasoning.path_index(source_ids).shortest_paths(target_id, total)
+        return [reasoning.describe(path) for path in paths]
+
+    def reporter(self, uuid: str, reasoning: ReasoningGraph, sources: list[int], target: int) -> Callable[[list[int]], None]:
+        """Returns a `connect_nodes` report publishing the new edges of every
+        chunk (appended to the earlier ones, see `APPENDED`) and the best path."""
+        def report(found):
+            edges = [(reasoning.text(reasoning.sources[edge]),
+                      reasoning.text(reasoning.targets[edge]),
+                      float(reasoning.scores[edge])) for edge in found]
+
+            if found and (paths := reasoning.path_index(sources).shortest_paths(target, 1)):
+                self.progress(uuid, "c", edges=edges, best=reasoning.describe(paths[0]))
+            else:
+                self.progress(uuid, "c", edges=edges)
 
-        return sorted(paths, key=lambda x: x[0], reverse=True)[:total]
+        return report
 
     def obtain_result(self, uuid: str) -> list:
         with self.access:
+            self.partial.pop(uuid, None)
             return self.cache.pop(uuid, [])
 
 
-reasoner = Reasoner()
-reasoner.start()
+# started by whoever runs the engine, see `engine.Engine`
+batcher = Batcher(WORKERS)
+reasoner = Reasoner(JOBS)
@@ -8,6 +8,14 @@ type StepParameter = {
 };
 type StepCallback = (state: "waiting" | "running" | "stopped") => any;
 
+type PartialResult = {
+  forward?: string[][];
+  backward?: string[][];
+  edges?: [string, string, number][];
+  best?: [number, string[]];
+};
+type StreamCallback = (state: string, partial: PartialResult) => any;
+
 type PathParameter = {
   source: string;
   target: string;
@@ -16,7 +24,12 @@ type PathParameter = {
   branch: number;
   total: number;
 };
-type PathCallback = (state: string, width: number, message: string) => any;
+type PathCallback = (
+  state: string,
+  width: number,
+  message: string,
+  partial: PartialResult
+) => any;
 
 type GraphParameter = {
   target: string;
@@ -25,47 +38,53 @@ type GraphParameter = {
   branch: number;
   total: number;
 };
-type GraphCallback = (state: string, width: number, message: string) => any;
+type GraphCallback = (
+  state: string,
+  width: number,
+  message: string,
+  partial: PartialResult
+) => any;
 
 class API {
   base: string = "http://localhost:3001";
 
-  titles?: [string, string][];
+  total?: number;
   ranges?: [string, string][];
+  titles: Map<string, [string, string][]> = new Map();
 
   // API calls related to the Story component
-  async query_and_cache() {
-    type ReturnType = { stories: [string, string][] };
+  async query_page(offset: number, limit: number) {
+    type ReturnType = { total: number; stories: [string, string][] };
 
-    // populate and cache this.titles
-    this.titles = await fetch(`${this.base}/api/story`)
+    return fetch(`${this.base}/api/story?offset=${offset}&limit=${limit}`)
       .then((response) => response.json())
-      .then((response: ReturnType) => response.stories);
+      .then((response: ReturnType) => response);
+  }
+
+  async query_ranges() {
+    if (this.ranges !== undefined) return this.ranges;
+
+    // only the total is needed to populate and cache this.ranges
+    this.total = (await this.query_page(0, 0)).total;
 
-    // populate and cache this.ranges
     this.ranges = [];
-    for (let group = 0; group * 1000 < this.titles.length; group++) {
+    for (let group = 0; group * 1000 < this.total; group++) {
       const lower = group * 1000;
-      const upper = Math.min(lower + 1000, this.titles.length);
+      const upper = Math.min(lower + 1000, this.total);
       this.ranges.push([group.toString(), `${lower} - ${upper}`]);
     }
-  }
-
-  async query_ranges() {
-    if (this.titles === undefined || this.ranges === undefined)
-      await this.query_and_cache();
 
-    return this.ranges!;
+    return this.ranges;
   }
 
   async query_titles(group: string) {
-    if (this.titles === undefined || this.ranges === undefined)
-      await this.query_and_cache();
-
-    const lower = parseInt(group) * 1000;
-    const upper = lower + 1000;
+    // fetch and cache each group of titles on first use
+    if (!this.titles.has(group)) {
+      const { stories } = await this.query_page(parseInt(group) * 1000, 1000);
+      this.titles.set(group, stories);
+    }
 
-    return this.titles!.slice(lower, upper);
+    return this.titles.get(group)!;
   }
 
   async query_story(uuid: string) {
@@ -79,10 +98,6 @@ class API {
   // API call related to the Step component
   async step_inference(parameters: StepParameter, callback: StepCallback) {
     type POSTReturnType = { uuid: string };
-    type GETReturnType = {
-      state: "waiting" | "running" | "stopped";
-      result?: [number, string][];
-    };
 
     // post inference task and obtain UUID
     const uuid = await fetch(`${this.base}/api/step`, {
@@ -96,31 +111,16 @@ class API {
       .then((response) => response.json())
       .then((response: POSTReturnType) => response.uuid);
 
-    // wait for inference task to finish
-    let result: GETReturnType = { state: "waiting" };
-    while (result.state !== "stopped") {
-      result = await fetch(`${this.base}/api/step/${uuid}`)
-        .then((response) => response.json())
-        .then((response: GETReturnType) => response);
-
-      callback(result.state);
-
-      await new Promise((resolve) => setTimeout(resolve, 200));
-    }
-
-    return result.result!;
+    // follow inference task until it finishes
+    return this.stream<[number, string][]>(
+      `${this.base}/api/step/${uuid}/stream`,
+      (state) => callback(state as "waiting" | "running" | "stopped")
+    );
   }
 
   // API call related to the Path component
   async path_inference(parameters: PathParameter, callback: PathCallback) {
     type POSTReturnType = { uuid: string };
-    type GETReturnType = {
-      state: string;
-      result?: [number, string[]][];
-    };
-
-    const path_length = parameters.length;
-    const total_steps = 4 + 2 * path_length;
 
     // post inference task and obtain UUID
     const uuid = await fetch(`${this.base}/api/path`, {
@@ -134,54 +134,19 @@ class API {
       .then((response) => response.json())
       .then((response: POSTReturnType) => response.uuid);
 
-    // wait for inference task to finish
-    let result: GETReturnType = { state: "waiting" };
-    while (result.state !== "stopped") {
-      result = await fetch(`${this.base}/api/path/${uuid}`)
-        .then((response) => response.json())
-        .then((response: GETReturnType) => response);
-
-      let width = 0;
-      let message = "";
-      if (result.state === "waiting") {
-        width = 1 / total_steps;
-        message = "Submitted";
-      } else if (result.state === "c") {
-        width = (1 + 2 * path_length) / total_steps;
-        message = "Connecting";
-      } else if (result.state === "s") {
-        width = (2 + 2 * path_length) / total_steps;
-        message = "Searching";
-      } else if (result.state === "stopped") {
-        width = 1;
-        message = "Completed";
-      } else if (result.state.startsWith("f")) {
-        width = (1 + parseInt(result.state.substring(1))) / total_steps;
-        message = `Forward search ${result.state.substring(1)}`;
-      } else if (result.state.startsWith("b")) {
-        width =
-          (1 + path_length + parseInt(result.state.substring(1))) / total_steps;
-        message = `Backward search ${result.state.substring(1)}`;
+    // follow inference task until it finishes
+    return this.stream<[number, string[]][]>(
+      `${this.base}/api/path/${uuid}/stream`,
+      (state, partial) => {
+        const [width, message] = this.progress(state, parameters.length);
+        callback(state, width, message, partial);
       }
-
-      callback(result.state, width, message);
-
-      await new Promise((resolve) => setTimeout(resolve, 200));
-    }
-
-    return result.result!;
+    );
   }
 
   // API call related to the Graph component
   async graph_inference(parameters: GraphParameter, callback: GraphCallback) {
     type POSTReturnType = { uuid: string };
-    type GETReturnType = {
-      state: string;
-      result?: [number, string[]][];
-    };
-
-    const path_length = parameters.length;
-    const total_steps = 4 + 2 * path_length;
 
     // post inference task and obtain UUID
     const uuid = await fetch(`${this.base}/api/graph`, {
@@ -195,43 +160,81 @@ class API {
       .then((response) => response.json())
       .then((response: POSTReturnType) => response.uuid);
 
-    // wait for inference task to finish
-    let result: GETReturnType = { state: "waiting" };
-    while (result.state !== "stopped") {
-      result = await fetch(`${this.base}/api/graph/${uuid}`)
-        .then((response) => response.json())
-        .then((response: GETReturnType) => response);
-
-      let width = 0;
-      let message = "";
-      if (result.state === "waiting") {
-        width = 1 / total_steps;
-        message = "Submitted";
-      } else if (result.state === "c") {
-        width = (1 + 2 * path_length) / total_steps;
-        message = "Connecting";
-      } else if (result.state === "s") {
-        width = (2 + 2 * path_length) / total_steps;
-        message = "Searching";
-      } else if (result.state === "stopped") {
-        width = 1;
-        message = "Completed";
-      } else if (result.state.startsWith("f")) {
-        width = (1 + parseInt(result.state.substring(1))) / total_steps;
-        message = `Forward search ${result.state.substring(1)}`;
-      } else if (result.state.startsWith("b")) {
-        width =
-          (1 + path_length + parseInt(result.state.substring(1))) / total_steps;
-        message = `Backward search ${result.state.substring(1)}`;
+    // follow inference task until it finishes
+    return this.stream<[number, string[]][]>(
+      `${this.base}/api/graph/${uuid}/stream`,
+      (state, partial) => {
+        const [width, message] = this.progress(state, parameters.length);
+        callback(state, width, message, partial);
       }
+    );
+  }
 
-      callback(result.state, width, message);
+  // follow the server-sent events of a task, resolves to the final result
+  stream<T>(url: string, callback: StreamCallback): Promise<T> {
+    return new Promise((resolve, reject) => {
+      const source = new EventSource(url);
+      const partial: PartialResult = {};
+
+      source.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+
+        if (event.state === "stopped") {
+          source.close();
+          callback(event.state, partial);
+          resolve(event.result as T);
+        } else if (event.state === "") {
+          source.close();
+          reject(new Error(`Unknown task: ${url}`));
+        } else if (event.state === "cancelled") {
+          source.close();
+          reject(new Error(`Cancelled task: ${url}`));
+        } else if (event.state === "error") {
+          source.close();
+          reject(new Error(`Failed task: ${event.error}`));
+        } else {
+          // edges arrive in parts, every other value replaces the last one
+          const { edges, ...rest } = event.partial;
+          Object.assign(partial, rest);
+          if (edges) partial.edges = (partial.edges ?? []).concat(edges);
+          callback(event.state, partial);
+        }
+      };
+
+      source.onerror = () => {
+        source.close();
+        reject(new Error(`Lost connection: ${url}`));
+      };
+    });
+  }
+
+  // progress bar width and message of a path or graph task state
+  progress(state: string, path_length: number): [number, string] {
+    const total_steps = 4 + 2 * path_length;
 
-      await new Promise((resolve) => setTimeout(resolve, 200));
+    if (state === "waiting") {
+      return [1 / total_steps, "Submitted"];
+    } else if (state === "c") {
+      return [(1 + 2 * path_length) / total_steps, "Connecting"];
+    } else if (state === "s") {
+      return [(2 + 2 * path_length) / total_steps, "Searching"];
+    } else if (state === "stopped") {
+      return [1, "Completed"];
+    } else if (state.startsWith("f")) {
+      return [
+        (1 + parseInt(state.substring(1))) / total_steps,
+        `Forward search ${state.substring(1)}`,
+      ];
+    } else if (state.startsWith("b")) {
+      return [
+        (1 + path_length + parseInt(state.substring(1))) / total_steps,
+        `Backward search ${state.substring(1)}`,
+      ];
     }
 
-    return result.result!;
+    return [0, ""];
   }
 }
 
+export type { PartialResult };
 export default new API();
@@ -1,10 +1,15 @@
 import React from "react";
 
-import API from "../API";
+import API, { PartialResult } from "../API";
 
 type ConfigProps = {
   context: string[];
-  onState: (state: string, width: number, message: string) => any;
+  onState: (
+    state: string,
+    width: number,
+    message: string,
+    partial: PartialResult
+  ) => any;
   onResult: (result: [number, string[]][]) => any;
 };
 type ConfigState = {
@@ -1,5 +1,6 @@
 import React from "react";
 
+import { PartialResult } from "../API";
 import Config from "./Config";
 import Result from "./Result";
 
@@ -12,8 +13,15 @@ type PathState = {
 class Path extends React.Component<PathProps, PathState> {
   state: PathState = {};
 
-  handleState(state: string, width: number, message: string) {
-    if (state !== "stopped") this.setState({ result: undefined });
+  handleState(
+    state: string,
+    width: number,
+    message: string,
+    partial: PartialResult
+  ) {
+    // show the best path found so far until the final result arrives
+    if (state !== "stopped")
+      this.setState({ result: partial.best && [partial.best] });
     this.setState({ state: [state, width, message] });
   }
 
@@ -53,8 +61,8 @@ class Path extends React.Component<PathProps, PathState> {
 
         <Config
           context={context}
-          onState={(state, width, message) =>
-            this.handleState(state, width, message)
+          onState={(state, width, message, partial) =>
+            this.handleState(state, width, message, partial)
           }
           onResult={(result) => this.handleResult(result)}
         />